@@ -1,23 +1,41 @@
 import logging
-import logging.config
+import queue
 import re
+import threading
 import time
 import warnings
+from collections import deque
 
 import os
+import numpy as np
 from PIL import Image
-from pywinauto import clipboard
-from pywinauto.application import Application, ProcessNotFoundError, AppStartError
-import win32gui
+try:
+    from pywinauto import clipboard
+    from pywinauto.application import Application, ProcessNotFoundError, AppStartError
+    import win32gui
+except ImportError:  # Not Windows, only replaying of recorded lists (scanner.replay) is possible
+    clipboard = Application = win32gui = None
+
+    class ProcessNotFoundError(Exception):
+        pass
+
+    class AppStartError(Exception):
+        pass
 
 from scanner.ocr import pil_to_opencv, ImageLibrary, ImageLogger, recognize_characters, recognize_flag, recognize_row
+from scanner.ocr import recognize_rows, PreparedRow, RowBuffers, RowTracker
 from scanner.ocr import FlagDoesNotExist, FlagTextIsNone, CharacterDoesNotExist, CharacterTextIsNone
+from scanner.ocr import RecordDoesNotExist, RecordTextIsNone, _digest
 from scanner import settings
+from scanner.logs import configure_logging
+from scanner.metrics import metrics
 
-logging.config.dictConfig(settings.LOGGING_CONFIG)
+configure_logging()
 logging.setLoggerClass(ImageLogger)
 log = logging.getLogger(__name__)
 
+ROW_ATTEMPTS = 4  # Attempts to read a row, the list is waited to be repainted between them
+
 libraries = {}
 
 
@@ -30,6 +48,7 @@ class Client:
         self.player_list = None
         self.table_list = None
         self.library_dir = library_dir
+        self.ocr_pool = None
 
     def connect(self):
         try:
@@ -66,20 +85,41 @@ class Client:
         self.connect_or_start()
         self.main_window = ClientWindow(self, title_re="PokerStars Lobby")
         self.move_main_window()
+        self.load_libraries()
+        self.create_lists(self.main_window)
+        self.close_not_main_windows()
+
+    def load_libraries(self):
         for key, value in settings.POKERSTARS['libraries'].items():
             library_path = os.path.join(self.library_dir, value)
             libraries[key] = ImageLibrary(library_path=library_path)
-        self.player_list = ClientList(self.main_window,
+
+    def create_lists(self, window, clipboard_source=None):
+        if settings.OCR_WORKERS and settings.MULTI_ROW and self.ocr_pool is None:
+            from scanner.pool import OcrPool
+            self.ocr_pool = OcrPool({'player_fields': settings.POKERSTARS['player_fields'],
+                                     'table_fields': settings.POKERSTARS['table_fields']})
+        self.player_list = ClientList(window,
                                       settings.POKERSTARS['player_list'],
                                       row=ListRow.from_dict(settings.POKERSTARS['player_list_row']),
                                       items=ListItem.fields_from_dict(settings.POKERSTARS['player_fields']),
+                                      multi_row=settings.MULTI_ROW,
+                                      clipboard_source=clipboard_source,
+                                      pool=self.ocr_pool,
+                                      pool_key='player_fields',
+                                      pipeline_size=settings.PIPELINE_SIZE,
+                                      roi_capture=settings.ROI_CAPTURE,
                                       )
-        self.table_list = ClientList(self.main_window,
+        self.table_list = ClientList(window,
                                      settings.POKERSTARS['table_list'],
                                      row=ListRow.from_dict(settings.POKERSTARS['table_list_row']),
                                      items=ListItem.fields_from_dict(settings.POKERSTARS['table_fields']),
+                                     multi_row=settings.MULTI_ROW,
+                                     clipboard_source=clipboard_source,
+                                     pool=self.ocr_pool,
+                                     pool_key='table_fields',
+                                     roi_capture=settings.ROI_CAPTURE,
                                      )
-        self.close_not_main_windows()
 
     def connect_or_start(self):
         if self.connect():
@@ -105,7 +145,13 @@ class Client:
         if libraries:
             for key in libraries.keys():
                 if key in include:
-                    libraries[key].save_library()
+                    libraries[key].save_changes()
+
+    def close(self):
+        """ Terminate worker processes of the OCR pool """
+        if self.ocr_pool is not None:
+            self.ocr_pool.close()
+            self.ocr_pool = None
 
     def close_not_main_windows(self):
         top_window = ClientWindow(self)
@@ -140,21 +186,82 @@ class ClientWindow:
         self.control.close()
 
 
+class ListCapture:
+    """ Capture of the column spans of the list control, that rows and items use, into a reused buffer
+
+    The buffer has the size of the whole control, so zones stay the same, other columns are black.
+    Every span is captured separately and written into its columns of the buffer.
+    It's overwritten by the next capture, so captured images must be copied to be kept.
+    The control has to capture a rectangle of the screen: capture_as_image(rect) of pywinauto controls,
+    replay.ReplayListControl crops recorded frames.
+    """
+
+    def __init__(self, control, spans):
+        self.control = control
+        self.spans = spans
+        self.buffer = None
+
+    @classmethod
+    def from_zones(cls, control, row, items):
+        """ Capture the zones of the row and the items, overlapping or adjacent zones are one span """
+        zones = sorted([row.zone] + [item.zone for item in items or [] if item.recognizer is not None])
+        spans = []
+        for left, right in zones:
+            if spans and left <= spans[-1][1]:
+                spans[-1] = (spans[-1][0], max(spans[-1][1], right))
+            else:
+                spans.append((left, right))
+        return cls(control, spans)
+
+    def capture(self):
+        rectangle = self.control.rectangle()
+        width, height = rectangle.right - rectangle.left, rectangle.bottom - rectangle.top
+        if self.buffer is None or self.buffer.shape != (height, width, 3):
+            self.buffer = np.zeros((height, width, 3), dtype=np.uint8)
+        for left, right in self.spans:
+            right = min(right, width)
+            if left >= right:
+                continue
+            image = self.control.capture_as_image(rect=type(rectangle)(rectangle.left + left, rectangle.top,
+                                                                       rectangle.left + right, rectangle.bottom))
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            self.buffer[:image.height, left:left + image.width] = image
+        return self.buffer
+
+
 class ListRow:
-    def __init__(self, recognizer, zone):
+    def __init__(self, recognizer, zone, rows_recognizer=None):
         self.image = None
+        self.images = []
+        self.prepared = None
         self.recognizer = recognizer
+        self.rows_recognizer = rows_recognizer
         self.zone = zone
+        self.buffers = RowBuffers()
+        self.tracker = RowTracker()
 
     def recognize(self, list_image):
         self.image = None
-        self.image = self.recognizer(list_image, self.zone)
+        self.prepared = None
+        self.image = self.recognizer(list_image, self.zone, tracker=self.tracker)
+        self.prepared = self.prepare(self.image)
+
+    def prepare(self, row_image):
+        """ Prepare row image once for all items, the previous prepared row becomes invalid """
+        return PreparedRow(row_image, self.buffers)
+
+    def recognize_all(self, list_image):
+        """ Recognize current row and all visible rows below it """
+        self.images = []
+        self.images = self.rows_recognizer(list_image, self.zone, tracker=self.tracker)
+        self.image = self.images[0]
 
     @classmethod
     def from_dict(cls, field_dict: dict):
         parsed_dict = {}
         for key, value in field_dict.items():
-            if key == 'recognizer':
+            if key == 'recognizer' or key == 'rows_recognizer':
                 parsed_dict[key] = eval(value)
             else:
                 parsed_dict[key] = value
@@ -162,8 +269,23 @@ class ListRow:
 
 
 class ClientList:
-    def __init__(self, window, control_name, row=None, items=None):
+    """ PokerStars list, that is walked row by row with keyboard
+
+    Names are read from clipboard, items are recognized in list screenshot.
+    In multi-row mode one screenshot is used for the current row and all visible rows below it:
+    recognized values of the rows are queued and then assigned to the items row by row,
+    while the keyboard walk only reads names. With pool (scanner.pool.OcrPool) the rows of a screenshot
+    are recognized by worker processes with the items of pool_key.
+    With capture (ListCapture) only the columns of zones are captured into a reused buffer.
+    In single-row mode with pipeline_size the walk only captures rows, their items are recognized by RowPipeline
+    and rows are yielded, when they are recognized, so the walk can go up to pipeline_size rows ahead of them.
+    The table list isn't pipelined, because players are scanned while its row is selected.
+    """
+
+    def __init__(self, window, control_name, row=None, items=None, multi_row=False, clipboard_source=None,
+                 pool=None, pool_key=None, pipeline_size=0, roi_capture=False):
         self.control = window.control[control_name]
+        self.clipboard_source = clipboard if clipboard_source is None else clipboard_source
         self.has_next = True
         self.clipboard = None
         self.previous_value = None
@@ -171,8 +293,20 @@ class ClientList:
         self.items = items
         self.image = None
         self.row: ListRow = row
+        self.multi_row = multi_row and row is not None and row.rows_recognizer is not None
+        self.queued_values = deque()
+        self.pool = pool
+        self.pool_key = pool_key
+        self.pipeline_size = pipeline_size
+        self.pipeline = None
+        self.row_id = None
+        self.row_digest = None  # Hashes of pixels of the list and current row in single-row mode
+        self.capture = ListCapture.from_zones(self.control, row, items) if roi_capture and row is not None else None
 
     def __iter__(self):
+        if self.pipeline_size and not self.multi_row and self.items is not None and self.row is not None:
+            yield from self._iter_pipelined()
+            return
         self.reset()
         while self.has_next:
             value_dict = dict()
@@ -183,58 +317,293 @@ class ClientList:
             yield value_dict
             self.get_next()
 
+    def _iter_pipelined(self):
+        self.pipeline = RowPipeline(self.items, self.pipeline_size)
+        pending = deque()  # Names and ids of captured rows, that aren't yielded yet
+        try:
+            self.reset()
+            while self.has_next:
+                pending.append((self.clipboard, self.row_id))
+                while pending and self.pipeline.is_ready(pending[0][1]):
+                    yield self._pipelined_values(*pending.popleft())
+                self.get_next()
+            while pending:
+                yield self._pipelined_values(*pending.popleft())
+        finally:
+            self.pipeline.close()
+            self.pipeline = None
+
+    def _pipelined_values(self, name, row_id):
+        value_dict = {'name': name}
+        values = self.pipeline.get(row_id) if row_id is not None else {}
+        for item in self.items:
+            value_dict[item.name] = values.get(item.name)
+        return value_dict
+
     def reset(self):
         self.control.set_focus()
-        self.control.type_keys('^{HOME}')
+        self.type_keys('^{HOME}')
         self.has_next = True
-        return self.get_row()
-
-    def get_row(self):
-        self.control.type_keys('^c')
-        self.clipboard = clipboard.GetData()
-        if self.items is not None and self.row is not None:
-            for i in range(4):  # 4 attempts to read row
-                if not self.get_items():
-                    time.sleep(4)
-                else:
-                    self.control.type_keys('^c')
-                    self.clipboard = clipboard.GetData()
-                    break
+        self.queued_values.clear()
+        self.get_row()
+        if self.clipboard is None:  # Nothing was copied, the list is empty
+            self.has_next = False
+        return self.clipboard
 
+    def type_keys(self, keys):
+        with metrics.time('keys'):
+            self.control.type_keys(keys)
+
+    def read_clipboard(self):
+        with metrics.time('clipboard'):
+            self.clipboard = self.clipboard_source.GetData()
         return self.clipboard
 
-    def get_items(self):
-        self.capture_as_image()
+    @property
+    def reads_rows(self):
+        """ Is every row captured and recognized separately (single-row mode) """
+        return not self.multi_row and self.items is not None and self.row is not None
+
+    def get_row(self, last_row_digest=None, is_copied=False):
+        """ Read name and items of current row with one clipboard copy
+
+        The name isn't copied again, if is_copied. In single-row mode the row is captured and recognized,
+        last_row_digest (the pixels of the last list and row) tells, if the list wasn't repainted yet.
+        """
+        if not is_copied:
+            self.type_keys('^c')
+            self.read_clipboard()
+        if self.reads_rows:
+            is_captured = False
+            for attempt in range(1, ROW_ATTEMPTS + 1):
+                if self.get_items(is_captured, last_row_digest):
+                    break
+                if attempt < ROW_ATTEMPTS:  # The capture after the last attempt wouldn't be used
+                    metrics.count('row_retries')
+                    is_captured = self.wait_for_repaint()
+            else:  # The row wasn't read, its items have no values, as in pipelined walk
+                for item in self.items:
+                    item.value = None
+            return self.clipboard
+        if self.multi_row and self.items is not None:
+            if not self.queued_values:
+                is_captured = False
+                for attempt in range(1, ROW_ATTEMPTS + 1):
+                    if self.get_all_items(is_captured):
+                        break
+                    if attempt < ROW_ATTEMPTS:
+                        metrics.count('row_retries')
+                        is_captured = self.wait_for_repaint()
+            self.set_queued_values()
+        return self.clipboard
+
+    def wait_for_repaint(self):
+        """ Poll captures of the list with exponential backoff, until the list differs from the last capture
+
+        Returns True, if the list was repainted and its new capture is the image,
+        False, if it wasn't repainted during settings.ROW_RETRY_DEADLINE seconds.
+        """
+        last_digest = _digest(self.image)
+        deadline = time.monotonic() + settings.ROW_RETRY_DEADLINE
+        wait = settings.ROW_RETRY_WAIT
+        with metrics.time('row_retry_wait'):
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    metrics.count('row_retry_timeouts')
+                    return False
+                time.sleep(min(wait, remaining))
+                self.capture_as_image()
+                if _digest(self.image) != last_digest:
+                    return True
+                wait = min(wait * 2, settings.ROW_RETRY_MAX_WAIT)
+
+    def get_items(self, is_captured=False, last_row_digest=None):
+        """ Recognize items of current row, in pipelined walk the row is put into the pipeline instead
+
+        The list is captured, unless is_captured. The same list as last_row_digest means, that it wasn't repainted
+        yet, so the row is read again. A row with the same pixels as the last one has the same values,
+        so it isn't recognized.
+        """
+        self.row_id = None
+        self.row_digest = None
+        if not is_captured:
+            self.capture_as_image()
         try:
             log.debug("Recognizing row...")
-            self.row.recognize(self.image)
+            with metrics.time('recognize_row'):
+                self.row.recognize(self.image)
         except ValueError:
             log.error("Can't recognize row.", extra={'images': [(self.image, 'wrong-row')]})
             return None
         else:
             log.debug("Row was recognized.", extra={'images': [(self.image, 'row')]})
+            self.row_digest = (_digest(self.image), _digest(self.row.image))
+            if last_row_digest is not None and self.row_digest[0] == last_row_digest[0]:
+                return None
+            if self.pipeline is not None:
+                self.row_id = self.pipeline.put(self.row.image.copy())
+                return self.items
+            if last_row_digest is not None and self.row_digest[1] == last_row_digest[1]:
+                return self.items
             for item in self.items:
-                item.recognize(self.row.image)
+                item.recognize(self.row.prepared)
             return self.items
 
+    def get_all_items(self, is_captured=False):
+        """ Recognize items of current row and all visible rows below it and queue their values
+
+        The list is captured, unless is_captured.
+        """
+        if not is_captured:
+            self.capture_as_image()
+        try:
+            log.debug("Recognizing rows...")
+            with metrics.time('recognize_rows'):
+                self.row.recognize_all(self.image)
+        except ValueError:
+            log.error("Can't recognize rows.", extra={'images': [(self.image, 'wrong-row')]})
+            return None
+        if self.pool is not None:
+            self.queued_values.extend(self.pool.recognize(self.pool_key, self.row.images))
+            return self.queued_values
+        for row_image in self.row.images:
+            prepared_row = self.row.prepare(row_image)
+            self.queued_values.append({item.name: item.recognize(prepared_row) for item in self.items})
+        return self.queued_values
+
+    def set_queued_values(self):
+        values = self.queued_values.popleft() if self.queued_values else {}
+        for item in self.items:
+            item.value = values.get(item.name)
+
+    def scroll_page(self):
+        """ Scroll list one page down, so next screenshot has as many new rows as possible """
+        try:
+            self.control.scroll('down', 'page')
+        except ValueError:  # The list has no scroll bar
+            pass
+
     def get_next(self):
         self.previous_value = self.clipboard
-        self.control.type_keys('{DOWN}')
+        if self.reads_rows:
+            self.type_keys('{DOWN}')
+            if self.copy_next_name():
+                self.get_row(last_row_digest=self.row_digest, is_copied=True)
+            return self.clipboard
+        if self.multi_row and not self.queued_values:
+            self.scroll_page()
+        self.type_keys('{DOWN}')
         self.get_row()
         if self.previous_value is not None and self.previous_value == self.clipboard:
-            self.control.type_keys('{DOWN}')
+            self.type_keys('{DOWN}')
             self.get_row()
             if self.previous_value is not None and self.previous_value == self.clipboard:
                 self.has_next = False
         return self.clipboard
 
+    def copy_next_name(self):
+        """ Copy the name after the selection was moved down, returns False at the end of the list
+
+        The same name as the last one means, that the selection didn't move. If the list has the same pixels
+        as at the last row, the list has ended, otherwise (e.g. values of the last row changed, or the key wasn't
+        handled yet) the selection is moved once more and the name is compared again.
+        """
+        self.type_keys('^c')
+        if self.read_clipboard() != self.previous_value or self.previous_value is None:
+            return True
+        if self.row_digest is not None:
+            self.capture_as_image()
+            if _digest(self.image) == self.row_digest[0]:
+                self.has_next = False
+                return False
+        self.type_keys('{DOWN}')
+        self.type_keys('^c')
+        if self.read_clipboard() != self.previous_value:
+            return True
+        self.has_next = False
+        return False
+
     def capture_as_image(self):
-        self.set_pil_image(self.control.capture_as_image())
+        with metrics.time('capture'):
+            if self.capture is not None:
+                self.image = self.capture.capture()
+            else:
+                self.set_pil_image(self.control.capture_as_image())
 
     def set_pil_image(self, pil_image: Image):
         self.image = pil_to_opencv(pil_image)
 
 
+class RowPipeline:
+    """ Thread, that recognizes items of rows in order of putting
+
+    put blocks, when size rows are waiting for recognition.
+    Values of a row are taken by id, that put returned, values of earlier rows are dropped.
+    """
+
+    def __init__(self, items, size):
+        self.items = items
+        self.buffers = RowBuffers()
+        self._rows = queue.Queue(maxsize=size)
+        self._results = queue.Queue()
+        self._done = {}
+        self._next_id = 0
+        self._thread = threading.Thread(target=self._run, name='row-ocr', daemon=True)
+        self._thread.start()
+
+    def put(self, row_image):
+        row_id = self._next_id
+        self._next_id += 1
+        with metrics.time('pipeline_put'):
+            self._rows.put((row_id, row_image))
+        return row_id
+
+    def _collect(self, block):
+        try:
+            row_id, values, exc = self._results.get(block)
+        except queue.Empty:
+            return False
+        self._done[row_id] = (values, exc)
+        return True
+
+    def is_ready(self, row_id):
+        """ Is the row with row_id recognized (a row without id is ready) """
+        while row_id is not None and row_id not in self._done and self._collect(block=False):
+            pass
+        return row_id is None or row_id in self._done
+
+    def get(self, row_id):
+        """ Wait for values of the row by item name """
+        with metrics.time('pipeline_get'):
+            while row_id not in self._done:
+                self._collect(block=True)
+        values, exc = self._done.pop(row_id)
+        for done_id in [done_id for done_id in self._done if done_id < row_id]:
+            del self._done[done_id]
+        if exc is not None:
+            raise exc
+        return values
+
+    def _run(self):
+        while True:
+            row_id, row_image = self._rows.get()
+            if row_id is None:
+                return
+            try:
+                prepared_row = PreparedRow(row_image, self.buffers)
+                values = {item.name: item.recognize(prepared_row) for item in self.items}
+            except Exception as exc:
+                log.error("Can't recognize items of row.", exc_info=True)
+                self._results.put((row_id, None, exc))
+            else:
+                self._results.put((row_id, values, None))
+
+    def close(self):
+        self._rows.put((None, None))
+        self._thread.join()
+
+
 class ListItem:
     def __init__(self, name, zone=(0, 0), recognizer=None, parser=None, library=None, **kwargs):
         self.name = name
@@ -244,6 +613,7 @@ class ListItem:
         self.library = library
         self.kwargs = kwargs
         self.value = None
+        self.stage = 'field_{}'.format(name)
 
     def __repr__(self):
         cls_name = self.__class__.__name__
@@ -254,43 +624,50 @@ class ListItem:
     def recognize(self, row_image):
         if self.recognizer:
             try:
-                self.value = self.recognizer(row_image, self.zone, self.library, **self.kwargs)
-            except FlagDoesNotExist as exc:
-                log.warning("Was created new record in flag library",
-                            extra={'images': [
-                                (exc.cropped_image, 'created-flag-row'),
-                                (exc.distinguished_image, 'created-flag-distinguished'),
-                            ]})
-                self.value = None
-            except CharacterDoesNotExist as exc:
-                log.warning("Was created new record in character library",
-                            extra={'images': [
-                                (exc.cropped_image, 'created-character-row'),
-                                (exc.distinguished_image, 'created-character-distinguished'),
-                            ]})
-                self.value = None
-            except FlagTextIsNone as exc:
-                log.warning("Flag record text is none",
-                            extra={'images': [
-                                (exc.distinguished_image, 'flag-text-is-none'),
-                            ]})
-                self.value = None
-            except CharacterTextIsNone as exc:
-                log.warning("Character record text is none",
-                            extra={'images': [
-                                (exc.distinguished_image, 'character-text-is-none'),
-                            ]})
+                with metrics.time(self.stage):
+                    self.value = self.recognizer(row_image, self.zone, self.library, **self.kwargs)
+            except (RecordDoesNotExist, RecordTextIsNone) as exc:
+                self.report(exc)
                 self.value = None
         if self.parser:
             self.value = self.parser(self.value)
         return self.value
 
+    def report(self, exc):
+        """ Count and log a record, that wasn't found or has no text """
+        if isinstance(exc, FlagDoesNotExist):
+            metrics.count('unknown_flags')
+            log.warning("Was created new record in flag library",
+                        extra={'images': [
+                            (exc.cropped_image, 'created-flag-row'),
+                            (exc.distinguished_image, 'created-flag-distinguished'),
+                        ]})
+        elif isinstance(exc, CharacterDoesNotExist):
+            metrics.count('unknown_glyphs')
+            log.warning("Was created new record in character library",
+                        extra={'images': [
+                            (exc.cropped_image, 'created-character-row'),
+                            (exc.distinguished_image, 'created-character-distinguished'),
+                        ]})
+        elif isinstance(exc, FlagTextIsNone):
+            metrics.count('unnamed_flags')
+            log.warning("Flag record text is none",
+                        extra={'images': [
+                            (exc.distinguished_image, 'flag-text-is-none'),
+                        ]})
+        elif isinstance(exc, CharacterTextIsNone):
+            metrics.count('unnamed_glyphs')
+            log.warning("Character record text is none",
+                        extra={'images': [
+                            (exc.distinguished_image, 'character-text-is-none'),
+                        ]})
+
     @classmethod
     def from_dict(cls, field_dict: dict):
         parsed_dict = {}
         for key, value in field_dict.items():
             if key == 'recognizer' or key == 'parser':
-                log.debug('key={} value={}'.format(key, value))
+                log.debug('key=%s value=%s', key, value)
                 parsed_dict[key] = eval(value)
             elif key == 'library':
                 parsed_dict[key] = libraries[value]
@@ -325,7 +702,7 @@ def float_parser(initial_value):
     if initial_value == '':
         return 0
     float_str = ''.join(re.findall(r'\d|\.', initial_value))
-    log.debug("Float initial_value={}, float_str={}".format(initial_value, float_str))
+    log.debug("Float initial_value=%s, float_str=%s", initial_value, float_str)
     try:
         return float(float_str)
     except ValueError:
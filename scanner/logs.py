@@ -0,0 +1,46 @@
+""" Logging configuration
+
+In queue mode (settings.LOG_QUEUE) loggers put records into a queue and handlers of settings.LOGGING_CONFIG
+(console, file, syslog) run in a listener thread, so a log call doesn't wait for their I/O.
+"""
+import atexit
+import logging.config
+import logging.handlers
+import queue
+
+from scanner import settings
+
+_is_configured = False
+_listener = None
+
+
+def queue_handlers(logger: logging.Logger):
+    """ Move handlers of the logger to a started listener, the logger gets QueueHandler instead """
+    handlers = logger.handlers[:]
+    for handler in handlers:
+        logger.removeHandler(handler)
+    records = queue.Queue()
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def configure_logging():
+    """ Apply settings.LOGGING_CONFIG once, later calls do nothing """
+    global _is_configured, _listener
+    if _is_configured:
+        return
+    logging.config.dictConfig(settings.LOGGING_CONFIG)
+    _is_configured = True
+    if settings.LOG_QUEUE:
+        _listener = queue_handlers(logging.getLogger())
+        atexit.register(stop_logging)
+
+
+def stop_logging():
+    """ Handle all queued records and stop the listener """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,129 @@
+""" Timing histograms of scan stages and counters of scan events
+
+Metrics are cumulative since start of the scanner and are dumped after every scan cycle
+to settings.METRICS_FILE: Prometheus text format if it ends with '.prom' (for textfile collector of node exporter),
+JSON otherwise. Metrics can be recorded from several threads (e.g. of scanner.client.RowPipeline).
+"""
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+
+from scanner import settings
+
+PREFIX = 'scanner'
+# Upper bounds of histogram buckets in seconds, the last bucket is +Inf
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def cumulative_counts(self):
+        total = 0
+        for count in self.counts:
+            total += count
+            yield total
+
+
+class _Timer:
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class Metrics:
+    def __init__(self):
+        self.histograms = {}
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def time(self, stage):
+        """ Context manager, that observes duration of the block as the stage """
+        return _Timer(self, stage)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'buckets': list(BUCKETS),
+                'stages': {stage: {'count': histogram.count, 'sum': histogram.sum, 'counts': list(histogram.counts)}
+                           for stage, histogram in sorted(self.histograms.items())},
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def to_prometheus(self):
+        with self._lock:
+            return self._to_prometheus()
+
+    def _to_prometheus(self):
+        lines = []
+        name = '{}_stage_seconds'.format(PREFIX)
+        if self.histograms:
+            lines.append('# HELP {} Duration of scan stages.'.format(name))
+            lines.append('# TYPE {} histogram'.format(name))
+        for stage, histogram in sorted(self.histograms.items()):
+            bounds = [repr(bound) for bound in BUCKETS] + ['+Inf']
+            for bound, count in zip(bounds, histogram.cumulative_counts()):
+                lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(name, stage, bound, count))
+            lines.append('{}_sum{{stage="{}"}} {!r}'.format(name, stage, histogram.sum))
+            lines.append('{}_count{{stage="{}"}} {}'.format(name, stage, histogram.count))
+        for counter, value in sorted(self.counters.items()):
+            counter_name = '{}_{}_total'.format(PREFIX, counter)
+            lines.append('# TYPE {} counter'.format(counter_name))
+            lines.append('{} {}'.format(counter_name, value))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path=None):
+        """ Write metrics to the file atomically, so a scraper never reads a partial file """
+        if path is None:
+            path = settings.METRICS_FILE
+        if not path:
+            return
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as file:
+            if path.endswith('.prom'):
+                file.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), file, indent=2)
+        os.replace(temp_path, path)
+
+
+metrics = Metrics()
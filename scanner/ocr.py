@@ -1,9 +1,15 @@
-import logging.config
+import base64
+import functools
+import hashlib
+import json
+import logging
 import pickle
 import time
-from collections import Counter
+from collections import Counter, OrderedDict, deque
 from enum import IntEnum
 import argparse
+import atexit
+import threading
 from tkinter import Tk, Label, Button, Entry
 import os
 
@@ -12,13 +18,186 @@ import numpy as np
 from PIL import Image, ImageTk
 
 from scanner import settings
+from scanner.logs import configure_logging
+from scanner.metrics import metrics
 
 TABLE_LIST = 0
 
+TEMPLATE_MATCHER = 'template'
+HAMMING_MATCHER = 'hamming'
+
+CONTOUR_SEGMENTER = 'contours'
+PROJECTION_SEGMENTER = 'projection'
+
+_POPCOUNT = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+
+LIBRARY_MAGIC = b'FFTLIB01'
+LIBRARY_ALIGNMENT = 16
+JOURNAL_SUFFIX = '.journal'
+TEXT_CACHE_SUFFIX = '.texts'
+QUARANTINE_SUFFIX = '.quarantine'
+HITS_SUFFIX = '.hits'
+
+# Stages of library lookup, where the record was found
+INDEX_STAGE = 'index'
+HOT_STAGE = 'hot'
+FULL_STAGE = 'full'
+MISS_STAGE = 'miss'
+LOOKUP_STAGES = (INDEX_STAGE, HOT_STAGE, FULL_STAGE, MISS_STAGE)
+DEPTH_BUCKETS = (8, 32, 128)
+
+ROW_INK_THRESHOLD = 200  # Pixels of rows, that are darker, are text or current row
+
+
+class ImageStore:
+    """ Directory of PNG images, that are deduplicated by content
+
+    The same image is saved once, index file keeps its occurrence counter and times of first and last occurrence.
+    When the images take more than max_size bytes, the least recently seen ones are deleted.
+    """
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, directory, max_size, params=()):
+        self.directory = directory
+        self.max_size = max_size
+        self.params = list(params)
+        self.entries = None  # File name to entry, the least recently seen first
+        self.size = 0
+        self._is_changed = False
+
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, self.INDEX_FILE)
+
+    def load(self):
+        self.entries = OrderedDict()
+        self.size = 0
+        try:
+            with open(self.index_path, 'r') as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            index = []
+        for entry in sorted(index, key=lambda entry: entry['last_seen']):
+            if os.path.exists(os.path.join(self.directory, entry['name'])):
+                self.entries[entry['name']] = entry
+                self.size += entry['size']
+
+    def add(self, image, file_name, prefix, seen):
+        if self.entries is None:
+            self.load()
+        entry = self.entries.get(file_name)
+        if entry is None:
+            path = os.path.join(self.directory, file_name)
+            if not cv2.imwrite(path, image, self.params):
+                raise OSError("Can't write image {}".format(path))
+            entry = {'name': file_name, 'prefix': prefix, 'count': 0, 'first_seen': seen,
+                     'size': os.path.getsize(path)}
+            self.entries[file_name] = entry
+            self.size += entry['size']
+        else:
+            self.entries.move_to_end(file_name)
+        entry['count'] += 1
+        entry['last_seen'] = seen
+        self._is_changed = True
+        self._evict()
+
+    def _evict(self):
+        while self.size > self.max_size and len(self.entries) > 1:
+            file_name, entry = self.entries.popitem(last=False)
+            try:
+                os.remove(os.path.join(self.directory, file_name))
+            except FileNotFoundError:
+                pass
+            self.size -= entry['size']
+            metrics.count('evicted_log_images')
+
+    def save(self):
+        """ Save index, the most frequent images first """
+        if not self._is_changed:
+            return
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(sorted(self.entries.values(), key=lambda entry: -entry['count']), file, indent=1)
+        os.replace(temp_path, self.index_path)
+        self._is_changed = False
+
+
+class ImageWriter:
+    """ Background writer of PNG images into ImageStore
+
+    Images are copied into a bounded queue, when the queue is full the oldest image is dropped,
+    so the caller never waits for hashing, encoding or disk. Only every N-th image of a prefix is saved,
+    if the prefix has N in sampling.
+    """
+
+    def __init__(self, directory=settings.LOG_PICTURE_PATH, queue_size=settings.LOG_PICTURE_QUEUE_SIZE,
+                 compression=settings.LOG_PICTURE_COMPRESSION, sampling=None,
+                 max_size=settings.LOG_PICTURE_MAX_SIZE * 2 ** 20):
+        self.store = ImageStore(directory, max_size, params=[cv2.IMWRITE_PNG_COMPRESSION, compression])
+        self.sampling = settings.LOG_PICTURE_SAMPLING if sampling is None else sampling
+        self._queue = deque(maxlen=queue_size)
+        self._condition = threading.Condition()
+        self._thread = None
+        self._writing = False
+        self._prefix_counter = Counter()
+        self.dropped = 0
+
+    def is_sampled(self, prefix):
+        every = self.sampling.get(prefix, 1)
+        self._prefix_counter[prefix] += 1
+        return (self._prefix_counter[prefix] - 1) % every == 0
+
+    def submit(self, image, prefix, seen=None, on_saved=None):
+        """ Queue the image, its file name depends only on the prefix and content
+
+        on_saved is called with the file name by the writer thread, when the image is saved.
+        """
+        image = np.array(image)  # The image can be a reused buffer
+        with self._condition:
+            if len(self._queue) == self._queue.maxlen:
+                self.dropped += 1
+                metrics.count('dropped_log_images')
+            self._queue.append((image, prefix, time.time() if seen is None else seen, on_saved))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='image-writer', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._writing = False
+                    self._condition.notify_all()
+                    self._condition.wait()
+                image, prefix, seen, on_saved = self._queue.popleft()
+                self._writing = True
+                is_last = not self._queue
+            try:
+                file_name = "{}-{}.png".format(prefix, _digest(image))
+                self.store.add(image, file_name, prefix, seen)
+                if is_last:
+                    self.store.save()
+            except Exception:
+                logging.getLogger(__name__).error("Can't save image of %s", prefix, exc_info=True)
+                continue
+            if on_saved is not None:
+                on_saved(file_name)
+
+    def flush(self, timeout=None):
+        """ Wait until all queued images and the index are written, return False on timeout """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._queue and not self._writing, timeout)
+
+
+image_writer = ImageWriter()
+atexit.register(image_writer.flush, 5)
+
 
 class ImageLogger(logging.Logger):
     """ Extended logger, that saving opencv images if extra has 'images'
 
+    Images are saved by image_writer in background, names of saved images are logged after saving.
      """
 
     def _log(self, level, msg, args, exc_info=None, extra=None, stack_info=False):
@@ -27,22 +206,30 @@ class ImageLogger(logging.Logger):
             if images:
                 tick = time.time()
                 for img, prefix in images:
-                    img_name = "{}-{}.png".format(prefix, tick)
-                    cv2.imwrite(os.path.join(settings.LOG_PICTURE_PATH, img_name), img)
-                    msg += " Image saved under name {}".format(img_name)
+                    if not image_writer.is_sampled(prefix):
+                        continue
+                    image_writer.submit(img, prefix, tick, on_saved=functools.partial(self._log_saved, level, msg))
         super()._log(level, msg, args, exc_info, extra, stack_info)
 
+    def _log_saved(self, level, msg, file_name):
+        self.log(level, "Image of '%s' saved under name %s", msg, file_name)
 
-logging.config.dictConfig(settings.LOGGING_CONFIG)
+
+configure_logging()
 logging.setLoggerClass(ImageLogger)
 log = logging.getLogger(__name__)
 logging.getLogger('PIL').setLevel(logging.WARNING)
 
 
 class ImageRecord:
-    def __init__(self, image, text):
+    hits = 0  # Defaults for records pickled before hits were counted
+    last_seen = None
+
+    def __init__(self, image, text, hits=0, last_seen=None):
         self.image = image
         self.text = text
+        self.hits = hits
+        self.last_seen = last_seen
 
     def __repr__(self):
         return "SymbolRecord({}, {})".format(self.image, self.text)
@@ -51,13 +238,291 @@ class ImageRecord:
         return np.array_equal(self.image, other.image) and self.text == other.text
 
 
+def _digest(image, *params):
+    """ Short stable hash of image content, its shape and extra parameters """
+    image_hash = hashlib.blake2b(repr((image.shape,) + params).encode('utf-8'), digest_size=16)
+    image_hash.update(image.tobytes())
+    return image_hash.hexdigest()
+
+
+class TextCache:
+    """ Texts recognized in field images, keyed by hash of thresholded field image
+
+    The first tier is in-memory LRU bounded by size. The optional second tier is saved to path
+    and survives restarts. Every entry keeps digests of records the text was built from,
+    so the entry is invalidated when one of the records is relabelled or deleted.
+    """
+
+    def __init__(self, size=settings.TEXT_CACHE_SIZE, path=None, persistent_size=settings.TEXT_CACHE_PERSISTENT_SIZE):
+        self.size = size
+        self.path = path
+        self.persistent_size = persistent_size
+        self.hits = 0
+        self.misses = 0
+        self._texts = OrderedDict()
+        self._persistent = OrderedDict()
+        self._is_changed = False
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        return None if entry is None else entry[0]
+
+    def get_entry(self, key):
+        """ Return (text, record digests) of the key or None """
+        entry = self._texts.get(key)
+        if entry is not None:
+            self._texts.move_to_end(key)
+        elif self.path is not None and key in self._persistent:
+            entry = self._persistent[key]
+            self._remember(key, entry)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def put(self, key, text, record_digests):
+        entry = (text, tuple(record_digests))
+        self._remember(key, entry)
+        if self.path is not None:
+            self._persistent[key] = entry
+            if len(self._persistent) > self.persistent_size:
+                self._persistent.popitem(last=False)
+            self._is_changed = True
+
+    def _remember(self, key, entry):
+        self._texts[key] = entry
+        if len(self._texts) > self.size:
+            self._texts.popitem(last=False)
+
+    def invalidate(self, record_digest):
+        for tier in (self._texts, self._persistent):
+            for key in [key for key, (_, digests) in tier.items() if record_digest in digests]:
+                del tier[key]
+                self._is_changed = True
+
+    def load(self):
+        if self.path is None:
+            return
+        try:
+            with open(self.path, 'r') as file:
+                entries = json.load(file)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            log.warning("Can't read text cache %s", self.path, exc_info=True)
+            return
+        self._persistent = OrderedDict((key, (text, tuple(digests))) for key, text, digests in entries)
+
+    def save(self):
+        if self.path is None or not self._is_changed:
+            return
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump([[key, text, digests] for key, (text, digests) in self._persistent.items()], file)
+        os.replace(temp_path, self.path)
+        self._is_changed = False
+
+
+def _encode_image(image):
+    return {'shape': list(image.shape), 'image': base64.b64encode(image.tobytes()).decode('ascii')}
+
+
+def _decode_image(data):
+    return np.frombuffer(base64.b64decode(data['image']), dtype=np.uint8).reshape(data['shape'])
+
+
+class Quarantine:
+    """ Unknown images, that weren't found in a library, keyed by hash of the image
+
+    The records aren't matched with other images, so unknown images don't slow down lookups in the library.
+    Every record counts its occurrences in hits. When there are more than size records,
+    the least recently seen one is dropped.
+    Saving appends new records, changed hits and removals to the journal, the file is rewritten by compact.
+    """
+
+    def __init__(self, size=settings.QUARANTINE_SIZE, path=None):
+        self.size = size
+        self.path = path
+        self.records = OrderedDict()
+        self._changed = set()  # Keys of records, that were added, counted or removed since the last saving
+        self._saved = set()  # Keys of records, whose images are in the file or journal
+        self._journal_size = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(list(self.records.values()))
+
+    @property
+    def journal_path(self):
+        return self.path + JOURNAL_SUFFIX
+
+    def get(self, image):
+        """ Return (was_created, record) of the image and count its occurrence """
+        key = _digest(image)
+        record = self.records.get(key)
+        was_created = record is None
+        if was_created:
+            if image.base is not None:  # A view can be of a reused row buffer
+                image = image.copy()
+            record = self.add(ImageRecord(image, None))
+        else:
+            self.records.move_to_end(key)
+        record.hits += 1
+        self._changed.add(key)
+        return was_created, record
+
+    def add(self, record: ImageRecord):
+        key = _digest(record.image)
+        record = self.records.setdefault(key, record)
+        self._changed.add(key)
+        if len(self.records) > self.size:
+            evicted_key, _ = self.records.popitem(last=False)
+            self._changed.add(evicted_key)
+            metrics.count('evicted_unknown_records')
+        return record
+
+    def find(self, key):
+        return self.records.get(key)
+
+    def remove(self, record: ImageRecord):
+        key = _digest(record.image)
+        removed = self.records.pop(key, None)
+        if removed is not None:
+            self._changed.add(key)
+        return removed is not None
+
+    def load(self):
+        self.records = OrderedDict()
+        if self.path is None:
+            return
+        try:
+            with open(self.path, 'r') as file:
+                entries = json.load(file)
+        except FileNotFoundError:
+            entries = []
+        except ValueError:
+            log.warning("Can't load quarantine %s", self.path, exc_info=True)
+            entries = []
+        for entry in entries:
+            self.add(ImageRecord(_decode_image(entry), None, entry['hits']))
+        self._replay_journal()
+        self._changed = set()
+        self._saved = set(self.records)
+
+    def _replay_journal(self):
+        """ Apply entries of the journal, broken lines (e.g. written during a crash) are skipped """
+        try:
+            with open(self.journal_path, 'r') as file:
+                lines = file.readlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            try:
+                entry = json.loads(line)
+                if 'image' in entry:
+                    self.add(ImageRecord(_decode_image(entry), None, entry['hits']))
+                elif entry['hits'] is None:
+                    self.records.pop(entry['key'], None)
+                elif entry['key'] in self.records:
+                    self.records[entry['key']].hits = entry['hits']
+                    self.records.move_to_end(entry['key'])
+            except (ValueError, KeyError, TypeError):
+                log.warning("Skipped broken line of quarantine journal %s", self.journal_path)
+        self._journal_size = len(lines)
+
+    def save(self):
+        """ Append changes since the last saving to the journal, it is compacted when it outgrows the quarantine """
+        if self.path is None or not self._changed:
+            return
+        lines = []
+        for key in self._changed:
+            record = self.records.get(key)
+            if record is None:
+                if key in self._saved:
+                    lines.append(json.dumps({'key': key, 'hits': None}))
+                    self._saved.discard(key)
+            elif key in self._saved:
+                lines.append(json.dumps({'key': key, 'hits': record.hits}))
+            else:
+                lines.append(json.dumps(dict(_encode_image(record.image), hits=record.hits)))
+                self._saved.add(key)
+        self._changed = set()
+        _append_lines(self.journal_path, lines)
+        self._journal_size += len(lines)
+        if self._journal_size > max(self.size, len(self.records)):
+            self.compact()
+
+    def compact(self):
+        """ Rewrite the file with all records and remove the journal """
+        if self.path is None:
+            return
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump([dict(_encode_image(record.image), hits=record.hits) for record in self.records.values()], file)
+        os.replace(temp_path, self.path)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self._changed = set()
+        self._saved = set(self.records)
+        self._journal_size = 0
+
+
+def _is_terminated(path):
+    """ Whether the file is empty or ends with a complete line, a crash can leave a broken last line """
+    try:
+        with open(path, 'rb') as file:
+            file.seek(-1, os.SEEK_END)
+            return file.read(1) == b'\n'
+    except OSError:  # No file or it is empty
+        return True
+
+
+def _append_lines(path, lines):
+    """ Append lines to the journal and flush them to disk """
+    if not lines:
+        return
+    is_terminated = _is_terminated(path)
+    with open(path, 'a') as file:
+        if not is_terminated:
+            file.write('\n')  # Don't append the first line to a broken line
+        for line in lines:
+            file.write(line + '\n')
+        file.flush()
+        os.fsync(file.fileno())
+
+
 class ImageLibrary:
+    """ Labelled image records grouped by image size
+
+    Images, that aren't found, are kept in the quarantine until they are labelled with relabel.
+    Iteration yields the labelled records and then the quarantined ones.
+    Every found record counts hits and the time it was last seen. Records of every size are ordered
+    by hits when the library is saved, lookups match the first settings.LIBRARY_HOT_RECORDS records first.
+    """
+
     def __init__(self, library_path=None, records=None):
+        self.text_cache = TextCache()
+        self.quarantine = Quarantine()
+        self.lookup_stages = Counter()  # (image size, stage) to number of lookups
+        self.lookup_candidates = Counter()  # Image size to number of examined records
+        self._hits_changed = False
+        self._index = None
+        self._digests = None
+        self._stacks = {}
+        self._bits = {}
+        self._blobs = {}
+        self._mapping = None
+        self._changes = []
+        self._journal_size = 0
         if library_path is None:
             if records is None:
                 self.records = {}
             else:
                 self.records = records
+                self._quarantine_unnamed()
         else:
             self.library_path = library_path
             self.load_library()
@@ -66,6 +531,7 @@ class ImageLibrary:
         for one_size_symbols in self.records.values():
             for symbol in one_size_symbols:
                 yield symbol
+        yield from self.quarantine
 
     def __str__(self):
         total = len([record for record in self])
@@ -73,57 +539,661 @@ class ImageLibrary:
         repeats = Counter(record.text for record in self).most_common(6)
         return "ImageLibrary Total: {}; Unnamed: {}; Repeats: {}".format(total, unnamed, repeats)
 
+    def report(self):
+        """ Statistics of every image size: hits, dead (never hit) records, depth of hits and lookups
+
+        Depth of hits is the share of hits of records, that are in the first N records of the size.
+        """
+        lines = [str(self)]
+        for image_size, records in sorted(self.records.items()):
+            hits = [record.hits for record in records]
+            total_hits = sum(hits)
+            dead = [record.text for record in records if not record.hits]
+            depths = ' '.join('{}: {:.0%}'.format(depth, sum(hits[:depth]) / total_hits if total_hits else 0)
+                              for depth in DEPTH_BUCKETS)
+            lines.append("{} Records: {}; Hits: {}; Dead: {} {}; Depth of hits {}".format(
+                image_size, len(records), total_hits, len(dead), dead[:10], depths))
+            lookups = sum(self.lookup_stages[image_size, stage] for stage in LOOKUP_STAGES)
+            if lookups:
+                stages = ' '.join('{}: {}'.format(stage, self.lookup_stages[image_size, stage])
+                                  for stage in LOOKUP_STAGES)
+                lines.append("    Lookups: {}; {}; Hit rate: {:.1%}; Candidates per lookup: {:.1f}".format(
+                    lookups, stages, 1 - self.lookup_stages[image_size, MISS_STAGE] / lookups,
+                    self.lookup_candidates[image_size] / lookups))
+        return '\n'.join(lines)
+
+    def _count_lookup(self, image_size, stage, record=None):
+        self.lookup_stages[image_size, stage] += 1
+        records_count = len(self.records.get(image_size, ()))
+        if stage == HOT_STAGE:
+            self.lookup_candidates[image_size] += min(records_count, settings.LIBRARY_HOT_RECORDS)
+        elif stage != INDEX_STAGE:
+            self.lookup_candidates[image_size] += records_count
+        if record is not None:
+            self._count_hit(record)
+
+    def _count_hit(self, record: ImageRecord):
+        record.hits += 1
+        record.last_seen = time.time()
+        self._hits_changed = True
+
+    def count_cached_hits(self, record_digests):
+        """ Count hits of records, which text was taken from the text cache without a lookup """
+        if self._digests is None:
+            self._digests = {_digest(record.image): record for records in self.records.values() for record in records}
+        for record_digest in record_digests:
+            record = self._digests.get(record_digest)
+            if record is not None:
+                self._count_hit(record)
+
+    def add_hits(self, image_key, hits, last_seen):
+        """ Add hits, that were counted by a copy of the library (e.g. in a worker process), to the record """
+        record = self.index.get(image_key)
+        if record is None:
+            return
+        record.hits += hits
+        record.last_seen = max(last_seen, record.last_seen or last_seen)
+        self._hits_changed = True
+
+    @staticmethod
+    def _image_key(image):
+        """ Key of exact-match index: shape plus raw bytes of image """
+        return image.shape, image.tobytes()
+
+    @property
+    def index(self):
+        """ Exact-match index of records, is built lazily after loading or deleting """
+        if self._index is None:
+            self._index = {}
+            for records in self.records.values():
+                for record in records:
+                    self._index.setdefault(self._image_key(record.image), record)
+        return self._index
+
+    @property
+    def journal_path(self):
+        return self.library_path + JOURNAL_SUFFIX
+
+    def _journal(self, operation, record: ImageRecord):
+        self._changes.append(dict(_encode_image(record.image), op=operation, text=record.text))
+
     def delete(self, record: ImageRecord):
+        if self.quarantine.remove(record):
+            return
+        if self._remove_record(record):
+            self._journal('delete', record)
+
+    def relabel(self, record: ImageRecord, text):
+        """ Change text of the record, a quarantined record is promoted into the library """
+        record.text = text
+        if self.quarantine.remove(record):
+            self._append_record(record)
+            self._journal('add', record)
+            return
+        self.text_cache.invalidate(_digest(record.image))
+        self._journal('relabel', record)
+
+    def _quarantine_unnamed(self):
+        """ Move unnamed records (of libraries saved before the quarantine) out of the library """
+        for record in [record for records in self.records.values() for record in records if record.text is None]:
+            self._remove_record(record)
+            self._journal('delete', record)
+            self.quarantine.add(record)
+
+    def _remove_record(self, record: ImageRecord):
         image_size = record.image.shape
         list_for_size = self.records.get(image_size)
         if list_for_size:
             list_for_size.remove(record)
+            self.text_cache.invalidate(_digest(record.image))
+            self._index = None
+            self._digests = None
+            self._stacks.pop(image_size, None)
+            self._bits.pop(image_size, None)
+            self._blobs.pop(image_size, None)
+            return True
+        return False
 
-    def get_image_record(self, image, min_matching=1.0):
-        was_created = False
-        image_size = self.records.setdefault(image.shape, list())
-        for record in image_size:
-            matching = cv2.matchTemplate(record.image, image, cv2.TM_CCOEFF_NORMED)[0][0]
-            if matching > 0.98:
-                record = record
-                break
+    @staticmethod
+    def _centered(images):
+        """ Flatten stacked images and subtract per-channel mean as TM_CCOEFF does """
+        channels = images.shape[3] if images.ndim == 4 else 1
+        centered = images.reshape(len(images), -1, channels).astype(np.float32)
+        centered -= centered.mean(axis=1, keepdims=True)
+        return centered.reshape(len(images), -1)
+
+    def _group_images(self, image_size):
+        """ All images of one size stacked in one array, the mapped blob is used while the group is unchanged """
+        images = self._blobs.get(image_size)
+        if images is None:
+            images = np.stack([record.image for record in self.records[image_size]])
+        return images
+
+    def _get_stack(self, image_size):
+        """ Centered images and norms of all records of one size, is built lazily """
+        stack = self._stacks.get(image_size)
+        if stack is None:
+            records = self.records.get(image_size)
+            if records:
+                centered = self._centered(self._group_images(image_size))
+            else:
+                centered = np.empty((0, int(np.prod(image_size))), dtype=np.float32)
+            norms = np.sqrt(np.einsum('ij,ij->i', centered, centered))
+            stack = self._stacks[image_size] = (centered, norms)
+        return stack
+
+    def _append_record(self, record: ImageRecord):
+        image_size = record.image.shape
+        self.records.setdefault(image_size, list()).append(record)
+        self._blobs.pop(image_size, None)
+        if self._index is not None:
+            self._index.setdefault(self._image_key(record.image), record)
+        if self._digests is not None:
+            self._digests.setdefault(_digest(record.image), record)
+        stack = self._stacks.get(image_size)
+        if stack is not None:
+            centered = self._centered(record.image[np.newaxis])
+            norm = np.sqrt(np.einsum('ij,ij->i', centered, centered))
+            self._stacks[image_size] = (np.vstack((stack[0], centered)), np.concatenate((stack[1], norm)))
+        bits = self._bits.get(image_size)
+        if bits is not None:
+            self._bits[image_size] = np.vstack((bits, self._packed(record.image[np.newaxis])))
+
+    @staticmethod
+    def _packed(images):
+        """ Pack stacked binary images into fixed-width bitsets, one row per image """
+        return np.packbits(images.reshape(len(images), -1) > 0, axis=1)
+
+    def _get_bits(self, image_size):
+        """ Bitsets of all records of one size, is built lazily """
+        bits = self._bits.get(image_size)
+        if bits is None:
+            records = self.records.get(image_size)
+            if records:
+                bits = self._packed(self._group_images(image_size))
+            else:
+                bits = np.empty((0, (int(np.prod(image_size)) + 7) // 8), dtype=np.uint8)
+            self._bits[image_size] = bits
+        return bits
+
+    def _match_hamming(self, image, start=0, stop=None):
+        """ Nearest record of the same size by Hamming distance between binarized images
+
+        Only records [start:stop] of the size are examined.
+        Returns the nearest record and the distance or (None, None) if there are no such records
+        """
+        bits = self._get_bits(image.shape)[start:stop]
+        if len(bits) == 0:
+            return None, None
+        distances = _POPCOUNT[np.bitwise_xor(bits, self._packed(image[np.newaxis]))].sum(axis=1, dtype=np.int32)
+        nearest = int(np.argmin(distances))
+        return self.records[image.shape][start + nearest], int(distances[nearest])
+
+    def _match_template(self, image, start=0, stop=None):
+        """ Normalized correlation (cv2.TM_CCOEFF_NORMED) of image with records of the same size
+
+        Only records [start:stop] of the size are examined.
+        Returns the best record and its matching or (None, 0.0) if there are no such records
+        """
+        centered, norms = self._get_stack(image.shape)
+        centered, norms = centered[start:stop], norms[start:stop]
+        if len(norms) == 0:
+            return None, 0.0
+        query = self._centered(image[np.newaxis])[0]
+        query_norm = np.sqrt(query.dot(query))
+        if query_norm < 1e-3:  # cv2 returns 1 for a flat template
+            matchings = np.ones(len(norms), dtype=np.float32)
         else:
-            was_created = True
-            record = ImageRecord(image, None)
-            image_size.append(record)
-        return was_created, record
+            with np.errstate(divide='ignore', invalid='ignore'):
+                matchings = centered.dot(query) / (norms * query_norm)
+            matchings[norms < 1e-3] = 0
+        best = int(np.argmax(matchings))
+        return self.records[image.shape][start + best], float(matchings[best])
+
+    def get_image_record(self, image, min_matching=1.0):
+        """ Return (was_created, record) of the image
+
+        If the image isn't found in the library, it is looked up in the quarantine and was_created is True
+        on its first occurrence.
+        """
+        image_key = self._image_key(image)
+        record = self.index.get(image_key)
+        if record is not None:
+            self._count_lookup(image.shape, INDEX_STAGE, record)
+            return False, record
+        stage = HOT_STAGE
+        record, matching = self._match_template(image, stop=settings.LIBRARY_HOT_RECORDS)
+        if record is None or matching <= 0.98:
+            stage = FULL_STAGE
+            record, matching = self._match_template(image, start=settings.LIBRARY_HOT_RECORDS)
+        if record is None or matching <= 0.98:
+            self._count_lookup(image.shape, MISS_STAGE)
+            return self.quarantine.get(image)
+        self._count_lookup(image.shape, stage, record)
+        self.index[image_key] = record
+        return False, record
+
+    def get_nearest_record(self, image, max_distance=1):
+        """ The same as get_image_record, but a binary image is matched by Hamming distance
+
+        A record matches if no more than max_distance pixels differ.
+        """
+        image_key = self._image_key(image)
+        record = self.index.get(image_key)
+        if record is not None:
+            self._count_lookup(image.shape, INDEX_STAGE, record)
+            return False, record
+        stage = HOT_STAGE
+        record, distance = self._match_hamming(image, stop=settings.LIBRARY_HOT_RECORDS)
+        if record is None or distance > max_distance:
+            stage = FULL_STAGE
+            record, distance = self._match_hamming(image, start=settings.LIBRARY_HOT_RECORDS)
+        if record is None or distance > max_distance:
+            self._count_lookup(image.shape, MISS_STAGE)
+            return self.quarantine.get(image)
+        self._count_lookup(image.shape, stage, record)
+        self.index[image_key] = record
+        return False, record
 
     def load_library(self):
         self.records = {}
+        self._index = None
+        self._digests = None
+        self._stacks = {}
+        self._bits = {}
+        self._blobs = {}
+        self._mapping = None
+        self._changes = []
+        self._journal_size = 0
         try:
             log.debug("Opening dataset file ")
             with open(self.library_path, 'rb') as file:
-                self.records = pickle.load(file)
+                is_packed = file.read(len(LIBRARY_MAGIC)) == LIBRARY_MAGIC
+                if not is_packed:
+                    file.seek(0)
+                    self.records = pickle.load(file)
+            if is_packed:
+                self._load_packed()
         except FileNotFoundError:
             log.warning("Can't open dataset file.", exc_info=True)
+        self._replay_journal()
+        self.quarantine = Quarantine(path=self.library_path + QUARANTINE_SUFFIX)
+        self.quarantine.load()
+        self._quarantine_unnamed()
+        self._load_hits()
+        text_cache_path = self.library_path + TEXT_CACHE_SUFFIX if settings.TEXT_CACHE_PERSISTENT else None
+        self.text_cache = TextCache(path=text_cache_path)
+        self.text_cache.load()
+
+    def _replay_journal(self):
+        """ Apply changes saved in the journal after the last compaction
+
+        Replaying is idempotent, so changes that already are in the library file are skipped.
+        Broken lines (e.g. written during a crash) are skipped too.
+        """
+        try:
+            with open(self.journal_path, 'r') as file:
+                lines = file.readlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            try:
+                change = json.loads(line)
+                image = _decode_image(change)
+            except (ValueError, KeyError):
+                log.warning("Skipped broken line of journal %s", self.journal_path)
+                continue
+            record = self.index.get(self._image_key(image))
+            if change['op'] == 'add' and record is None:
+                self._append_record(ImageRecord(image, change['text']))
+            elif change['op'] == 'relabel' and record is not None:
+                record.text = change['text']
+            elif change['op'] == 'delete' and record is not None:
+                self._remove_record(record)
+        self._journal_size = len(lines)
+
+    def save_changes(self):
+        """ Append changes since the last saving to the journal
+
+        The journal is compacted into the library file when it has more than settings.LIBRARY_JOURNAL_LIMIT changes.
+        """
+        if self._changes:
+            _append_lines(self.journal_path, [json.dumps(change) for change in self._changes])
+            self._journal_size += len(self._changes)
+            self._changes = []
+        self.text_cache.save()
+        self.quarantine.save()
+        self._save_hits()
+        if self._journal_size > settings.LIBRARY_JOURNAL_LIMIT:
+            self.save_library()
+
+    @property
+    def hits_path(self):
+        return self.library_path + HITS_SUFFIX
+
+    def _save_hits(self):
+        """ Save hits and last seen times of records, they get into the library file when it is saved """
+        if not self._hits_changed:
+            return
+        hits = {_digest(record.image): [record.hits, record.last_seen]
+                for records in self.records.values() for record in records if record.hits}
+        temp_path = self.hits_path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(hits, file)
+        os.replace(temp_path, self.hits_path)
+        self._hits_changed = False
+
+    def _load_hits(self):
+        try:
+            with open(self.hits_path, 'r') as file:
+                hits = json.load(file)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            log.warning("Can't load hits %s", self.hits_path, exc_info=True)
+            return
+        for records in self.records.values():
+            for record in records:
+                record.hits, record.last_seen = hits.get(_digest(record.image), (record.hits, record.last_seen))
+
+    def order_by_hits(self):
+        """ Order records of every size by hits, so the most frequent are matched first """
+        for image_size, records in self.records.items():
+            records.sort(key=lambda record: -record.hits)
+            self._stacks.pop(image_size, None)
+            self._bits.pop(image_size, None)
+            self._blobs.pop(image_size, None)
+
+    def compact(self, matcher=TEMPLATE_MATCHER, min_matching=0.98, max_distance=1):
+        """ Merge near-duplicate records of every size, including quarantined ones
+
+        Records of a cluster (see cluster_images) are merged into its most hit labelled record, that gets
+        the hits of the cluster, so the label is propagated to the unlabelled ones.
+        Clusters with different labels are left as is and returned as lists of records.
+        """
+        conflicts = []
+        quarantined = {}
+        for record in self.quarantine:
+            quarantined.setdefault(record.image.shape, []).append(record)
+        for image_size in set(self.records) | set(quarantined):
+            records = self.records.get(image_size, []) + quarantined.get(image_size, [])
+            records.sort(key=lambda record: -record.hits)
+            kept = []
+            for cluster in cluster_images([record.image for record in records], matcher, min_matching, max_distance):
+                cluster = [records[index] for index in cluster]
+                texts = {record.text for record in cluster if record.text is not None}
+                if len(texts) > 1:
+                    conflicts.append(cluster)
+                    kept.extend(cluster)
+                    continue
+                keeper = next((record for record in cluster if record.text is not None), cluster[0])
+                keeper.hits = sum(record.hits for record in cluster)
+                keeper.last_seen = max((record.last_seen for record in cluster if record.last_seen is not None),
+                                       default=None)
+                kept.append(keeper)
+                for record in cluster:
+                    if record is not keeper and not self.quarantine.remove(record):
+                        self.text_cache.invalidate(_digest(record.image))
+                        self._journal('delete', record)
+            if image_size in self.records:
+                kept_ids = {id(record) for record in kept}
+                self.records[image_size] = [record for record in records
+                                            if id(record) in kept_ids and record.text is not None]
+        self._index = None
+        self._digests = None
+        self._stacks = {}
+        self._bits = {}
+        self._blobs = {}
+        self._hits_changed = True
+        return conflicts
+
+    def _load_packed(self):
+        """ Map packed library file, record images are zero-copy views of the mapped blobs
+
+        File layout: magic, header size (8 bytes, little endian), json header, aligned blobs.
+        Every blob holds all images of one size one after another, blob offsets are counted from the first blob.
+        """
+        self._mapping = np.memmap(self.library_path, dtype=np.uint8, mode='r')
+        header_start = len(LIBRARY_MAGIC) + 8
+        header_size = int.from_bytes(bytes(self._mapping[len(LIBRARY_MAGIC):header_start]), 'little')
+        header = json.loads(bytes(self._mapping[header_start:header_start + header_size]).decode('utf-8'))
+        data_start = _aligned(header_start + header_size)
+        for group in header['groups']:
+            image_size = tuple(group['shape'])
+            count = len(group['texts'])
+            blob_start = data_start + group['offset']
+            blob_size = count * int(np.prod(image_size))
+            images = np.asarray(self._mapping[blob_start:blob_start + blob_size]).reshape((count,) + image_size)
+            self._blobs[image_size] = images
+            last_seen = group.get('last_seen', [None] * count)
+            self.records[image_size] = [ImageRecord(image, text, hits, seen) for image, text, hits, seen
+                                        in zip(images, group['texts'], group['hits'], last_seen)]
+
+    def _release_mapping(self):
+        """ Copy record images out of the mapped file, so the file can be replaced """
+        if self._mapping is not None:
+            for record in self:
+                record.image = np.array(record.image)
+            self._blobs = {}
+            self._mapping = None
 
     def save_library(self):
-        with open(self.library_path, 'wb') as file:
-            pickle.dump(self.records, file)
+        self._release_mapping()
+        self.order_by_hits()
+        groups = []
+        blobs = []
+        offset = 0
+        for image_size, records in self.records.items():
+            if not records:
+                continue
+            blob = np.stack([record.image for record in records]).tobytes()
+            groups.append({'shape': list(image_size),
+                           'offset': offset,
+                           'texts': [record.text for record in records],
+                           'hits': [record.hits for record in records],
+                           'last_seen': [record.last_seen for record in records]})
+            blobs.append(blob)
+            offset += _aligned(len(blob))
+        header = json.dumps({'groups': groups}).encode('utf-8')
+        header_end = len(LIBRARY_MAGIC) + 8 + len(header)
+        temp_path = self.library_path + '.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(LIBRARY_MAGIC)
+            file.write(len(header).to_bytes(8, 'little'))
+            file.write(header)
+            file.write(b'\0' * (_aligned(header_end) - header_end))
+            for blob in blobs:
+                file.write(blob)
+                file.write(b'\0' * (-len(blob) % LIBRARY_ALIGNMENT))
+        os.replace(temp_path, self.library_path)
+        for path in (self.journal_path, self.hits_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self._hits_changed = False
+        self._changes = []
+        self._journal_size = 0
+        self.text_cache.save()
+        self.quarantine.compact()
+
+
+def cluster_images(images, matcher=TEMPLATE_MATCHER, min_matching=0.98, max_distance=1):
+    """ Split images of one size into clusters of near-duplicates, returns lists of indexes
+
+    Clusters are formed in order of images: the first image, that isn't clustered yet, takes all not clustered
+    images, that it matches as a lookup of the matcher would (see ImageLibrary.get_image_record and
+    get_nearest_record).
+    """
+    if not images:
+        return []
+    stacked = np.stack(images)
+    if matcher == HAMMING_MATCHER:
+        bits = ImageLibrary._packed(stacked)
+    else:
+        centered = ImageLibrary._centered(stacked)
+        norms = np.sqrt(np.einsum('ij,ij->i', centered, centered))
+    clusters = []
+    is_free = np.ones(len(images), dtype=bool)
+    for leader in range(len(images)):
+        if not is_free[leader]:
+            continue
+        if matcher == HAMMING_MATCHER:
+            matches = _POPCOUNT[np.bitwise_xor(bits, bits[leader])].sum(axis=1) <= max_distance
+        elif norms[leader] < 1e-3:  # Flat images match only each other
+            matches = norms < 1e-3
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                matches = centered.dot(centered[leader]) / (norms * norms[leader]) > min_matching
+        members = np.flatnonzero(matches & is_free)
+        is_free[members] = False
+        clusters.append([leader] + [int(member) for member in members if member != leader])
+    return clusters
+
+
+def _aligned(size):
+    return -(-size // LIBRARY_ALIGNMENT) * LIBRARY_ALIGNMENT
+
+
+def convert_library(library_path, packed_path=None):
+    """ One-shot conversion of a pickled library into the packed format """
+    library = ImageLibrary(library_path=library_path)
+    if packed_path is not None:
+        library.library_path = packed_path
+    library.save_library()
+    return library
 
 
 def crop_image(image, y1, y2, x1, x2):
     return image[y1:y2, x1:x2]
 
 
-def recognize_row(image, zone):
-    """ Find current row in PokerStars list """
-    gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    cropped_image = gray_image[:, zone[0]:zone[1]]
-    _, thresh_image = cv2.threshold(cropped_image, 200, 255, cv2.THRESH_BINARY_INV)
+class RowBuffers:
+    """ Preallocated arrays reused for every row of a list """
+
+    def __init__(self):
+        self._buffers = {}
+
+    def get(self, name, shape, dtype=np.uint8):
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = self._buffers[name] = np.empty(shape, dtype=dtype)
+        return buffer
+
+
+class PreparedRow:
+    """ Row image with grayscale and thresholded versions of zones, that are computed once and shared by all fields
+
+    Only the zones, that fields read, are converted, so the rest of the row costs nothing.
+    With buffers the versions are written into preallocated arrays, so they are valid only until the next row
+    is prepared with the same buffers.
+    """
+
+    def __init__(self, image, buffers: RowBuffers = None):
+        self.image = image
+        self.buffers = buffers
+        self._grays = {}
+        self._thresholds = {}
+
+    def _buffer(self, name, zone):
+        if self.buffers is None:
+            return None
+        return self.buffers.get(name, (self.image.shape[0], zone[1] - zone[0]))
+
+    def gray(self, zone):
+        """ Grayscale columns of the zone """
+        zone = tuple(zone)
+        gray = self._grays.get(zone)
+        if gray is None:
+            gray = cv2.cvtColor(self.image[:, zone[0]:zone[1]], cv2.COLOR_BGR2GRAY,
+                                dst=self._buffer(('gray', zone), zone))
+            self._grays[zone] = gray
+        return gray
+
+    def threshold(self, value, threshold_type, zone):
+        """ Thresholded columns of the zone """
+        zone = tuple(zone)
+        key = (value, threshold_type, zone)
+        thresh = self._thresholds.get(key)
+        if thresh is None:
+            _, thresh = cv2.threshold(self.gray(zone), value, 255, threshold_type,
+                                      dst=self._buffer(('threshold',) + key, zone))
+            self._thresholds[key] = thresh
+        return thresh
+
+
+def prepare_row(row_image):
+    if isinstance(row_image, PreparedRow):
+        return row_image
+    return PreparedRow(row_image)
+
+
+def _find_row(image, zone):
+    """ Find top and height of current row in PokerStars list """
+    cropped_image = cv2.cvtColor(image[:, zone[0]:zone[1]], cv2.COLOR_BGR2GRAY)
+    _, thresh_image = cv2.threshold(cropped_image, ROW_INK_THRESHOLD, 255, cv2.THRESH_BINARY_INV)
     _, contours, _ = cv2.findContours(thresh_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     if len(contours) == 1:
         [x, y, w, h] = cv2.boundingRect(contours[0])
     else:
         raise ValueError("Can't recognize row")
-    row_top = y
-    row_bottom = y + h
-    return image[row_top:row_bottom, :]
+    return y, h
+
+
+class RowTracker:
+    """ Finder of current row, that searches near the last found row first
+
+    Walking with keyboard moves current row by one row or keeps it in place, when the list scrolls,
+    so the row is looked for in a window from one row above to two rows below the last one.
+    The whole column is searched, if the row isn't found in the window or touches its edge.
+    """
+
+    def __init__(self):
+        self.top = None
+        self.height = None
+
+    def find(self, image, zone):
+        """ Return top and height of current row """
+        if self.top is not None:
+            window_top = max(self.top - self.height - 1, 0)
+            window_bottom = min(self.top + 2 * self.height + 1, image.shape[0])
+            try:
+                row_top, row_height = _find_row(image[window_top:window_bottom], zone)
+            except ValueError:
+                pass
+            else:
+                is_inside = ((row_top > 0 or window_top == 0) and
+                             (row_top + row_height < window_bottom - window_top or window_bottom == image.shape[0]))
+                if is_inside and row_height == self.height:
+                    self.top = window_top + row_top
+                    return self.top, self.height
+            metrics.count('row_tracker_misses')
+        self.top = self.height = None
+        self.top, self.height = _find_row(image, zone)
+        return self.top, self.height
+
+
+def recognize_row(image, zone, tracker: RowTracker = None):
+    """ Find current row in PokerStars list """
+    row_top, row_height = _find_row(image, zone) if tracker is None else tracker.find(image, zone)
+    return image[row_top:row_top + row_height, :]
+
+
+def recognize_rows(image, zone, tracker: RowTracker = None):
+    """ Find current row and all fully visible rows below it in PokerStars list
+
+    All rows have the same height as the current row. Rows end at the first empty row (without dark pixels),
+    that is below the end of a short list.
+    """
+    row_top, row_height = _find_row(image, zone) if tracker is None else tracker.find(image, zone)
+    rows = [image[row_top:row_top + row_height, :]]
+    below_top = row_top + row_height
+    if below_top + row_height > image.shape[0]:
+        return rows
+    gray = cv2.cvtColor(image[below_top:], cv2.COLOR_BGR2GRAY)
+    for top in range(0, gray.shape[0] - row_height + 1, row_height):
+        if gray[top:top + row_height].min() >= ROW_INK_THRESHOLD:
+            break
+        rows.append(image[below_top + top:below_top + top + row_height, :])
+    return rows
 
 
 class OcrException(Exception):
@@ -179,35 +1249,94 @@ class CharacterTextIsNone(RecordTextIsNone):
                                              msg='Character exist but text is None')
 
 
-def recognize_characters(row_image, zone, library, **kwargs):
+def recognize_characters(row_image, zone, library, matcher=TEMPLATE_MATCHER, max_distance=1,
+                         segmenter=CONTOUR_SEGMENTER, **kwargs):
+    """ Recognize text in the zone of the row
+
+    matcher selects how a character is looked up in the library: TEMPLATE_MATCHER (normalized correlation)
+    or HAMMING_MATCHER (no more than max_distance differing pixels).
+    segmenter selects how the text is split into characters: CONTOUR_SEGMENTER or PROJECTION_SEGMENTER.
+    """
     log.debug("Recognizing text...")
-    cropped_image = crop_image(row_image, None, None, zone[0], zone[1])
-    gray_image = cv2.cvtColor(cropped_image, cv2.COLOR_BGR2GRAY)
-    _, thresh = cv2.threshold(gray_image, 160, 255, cv2.THRESH_BINARY)
-    _, contours, hierarchy = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    row = prepare_row(row_image)
+    cropped_image = crop_image(row.image, None, None, zone[0], zone[1])
+    gray_image = row.gray(zone)
+    # Text of current row is light on dark background, text of other rows is dark on light background
+    threshold_type = cv2.THRESH_BINARY_INV if np.median(gray_image) > 160 else cv2.THRESH_BINARY
+    thresh = row.threshold(160, threshold_type, zone)
+    cache_key = _digest(thresh, matcher, max_distance, segmenter)
+    entry = library.text_cache.get_entry(cache_key)
+    if entry is not None:
+        text, record_digests = entry
+        library.count_cached_hits(record_digests)
+        return text
+    record_digests = []
+    if segmenter == PROJECTION_SEGMENTER:
+        united_rects, spaces = _segment_by_projection(thresh)
+    else:
+        united_rects, spaces = _segment_by_contours(thresh)
     text = ""
-    intersected_rects = []
-    for cnt in contours:
-        (x, y, w, h) = cv2.boundingRect(cnt)
-        if w < 10:  # Remove unexpected big artefacts
-            intersected_rects.append((x, y, w, h))
-    intersected_rects.sort(key=lambda x: x[0])
-    united_rects = _get_united(intersected_rects)
-    for index, (x, y, w, h) in enumerate(united_rects):
+    for (x, y, w, h), space in zip(united_rects, spaces):
         symbol_image = thresh[y:y + h, x:x + w]
-        was_created, symbol_record = library.get_image_record(symbol_image)
+        if matcher == HAMMING_MATCHER:
+            was_created, symbol_record = library.get_nearest_record(symbol_image, max_distance=max_distance)
+        else:
+            was_created, symbol_record = library.get_image_record(symbol_image)
         if was_created:
             raise CharacterDoesNotExist(library, cropped_image, symbol_image)
         elif symbol_record.text is None:
             raise CharacterTextIsNone(library, cropped_image, symbol_image)
         text += str(symbol_record.text)
-        if index > 0 and _check_space(united_rects[index - 1], (x, y, w, h)):
+        record_digests.append(_digest(symbol_record.image))
+        if space:
             text += ' '
+    library.text_cache.put(cache_key, text, record_digests)
     return text
 
 
+def _segment_by_contours(thresh):
+    """ Split text into character rects by external contours, intersected rects are united
+
+    Returns the rects sorted by x and flags of spaces before them.
+    """
+    _, contours, hierarchy = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    intersected_rects = []
+    for cnt in contours:
+        (x, y, w, h) = cv2.boundingRect(cnt)
+        if w < 10:  # Remove unexpected big artefacts
+            intersected_rects.append((x, y, w, h))
+    intersected_rects.sort(key=lambda x: x[0])
+    united_rects = _get_united(intersected_rects)
+    spaces = [index > 0 and _check_space(united_rects[index - 1], rect) for index, rect in enumerate(united_rects)]
+    return united_rects, spaces
+
+
+def _segment_by_projection(thresh):
+    """ Split text into character rects by column projection profile
+
+    A character is a run of columns that have foreground pixels, its height is found by row profile of the run.
+    Gives the same rects as _segment_by_contours unless characters touch each other
+    without empty column between them (e.g. underscore in names), so it suits numeric fields.
+    Returns the rects sorted by x and flags of spaces before them.
+    """
+    foreground = thresh > 0
+    padded = np.concatenate(([False], foreground.any(axis=0), [False]))
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    starts, widths = edges[::2], edges[1::2] - edges[::2]
+    if len(starts) == 0:
+        return [], []
+    run_rows = np.logical_or.reduceat(foreground, starts, axis=1)
+    tops = run_rows.argmax(axis=0)
+    heights = len(foreground) - run_rows[::-1].argmax(axis=0) - tops
+    is_character = widths < 10  # Remove unexpected big artefacts
+    xs, ys, widths, heights = starts[is_character], tops[is_character], widths[is_character], heights[is_character]
+    spaces = np.concatenate(([False], xs[1:] - (xs[:-1] + widths[:-1] - 1) > 3))
+    rects = [tuple(int(value) for value in rect) for rect in zip(xs, ys, widths, heights)]
+    return rects, spaces.tolist()
+
+
 def recognize_flag(row_image, zone, library, **kwargs):
-    cropped_image = crop_image(row_image, None, None, zone[0], zone[1])
+    cropped_image = crop_image(prepare_row(row_image).image, None, None, zone[0], zone[1])
     flag_image = _distinguish_flag(cropped_image)
     if flag_image.shape != (16, 22, 3) and flag_image.shape != (16, 18, 3):
         log.error("Wrong flag size", extra={'images': [(cropped_image, 'wrong-size-flag-field'),
@@ -322,7 +1451,9 @@ def _check_space(previous_rect, rect):
 
 
 def pil_to_opencv(pil_image: Image) -> cv2:
-    open_cv_image = np.array(pil_image.convert('RGB'))
+    if pil_image.mode != 'RGB':  # convert copies the image even if it's RGB already
+        pil_image = pil_image.convert('RGB')
+    open_cv_image = np.array(pil_image)
     return open_cv_image
 
 
@@ -382,8 +1513,8 @@ class TrainGUI:
         self.reset_iterator()
 
     def reset_iterator(self):
-        if self.only_empty:
-            self.iterator = iter((s_record for s_record in self.library if not s_record.text))
+        if self.only_empty:  # The most frequent unknown images first
+            self.iterator = iter(sorted(self.library.quarantine, key=lambda record: -record.hits))
         else:
             self.iterator = iter(self.library)
         self.symbol_record = next(self.iterator)
@@ -392,7 +1523,7 @@ class TrainGUI:
 
     def train(self):
         if self.entry.get() != '':
-            self.symbol_record.text = self.entry.get()
+            self.library.relabel(self.symbol_record, self.entry.get())
         self.symbol_record = next(self.iterator)
         if self.symbol_record:
             self._update_label()
@@ -422,6 +1553,51 @@ class TrainGUI:
         self.master.quit()
 
 
+def print_quarantine(library_path, image_dir=''):
+    library = ImageLibrary(library_path=library_path)
+    for key, record in sorted(library.quarantine.records.items(), key=lambda item: -item[1].hits):
+        print("{} hits: {} shape: {}".format(key, record.hits, record.image.shape))
+        if image_dir:
+            cv2.imwrite(os.path.join(image_dir, '{}.png'.format(key)), record.image)
+
+
+def promote_record(library_path, key, text):
+    library = ImageLibrary(library_path=library_path)
+    record = library.quarantine.find(key)
+    if record is None:
+        print("Image {} isn't in the quarantine".format(key))
+        return
+    library.relabel(record, text)
+    library.save_changes()
+    print(str(library))
+
+
+def compact_library(library_path, compact_path=None, matcher=TEMPLATE_MATCHER, min_matching=0.98,
+                    max_distance=1):
+    """ Merge near-duplicate records and save the library (into compact_path), returns conflicting clusters """
+    library = ImageLibrary(library_path=library_path)
+    total = len(list(library))
+    conflicts = library.compact(matcher, min_matching, max_distance)
+    if compact_path is not None:
+        library.library_path = compact_path
+        library.quarantine.path = compact_path + QUARANTINE_SUFFIX
+        if library.text_cache.path is not None:
+            library.text_cache.path = compact_path + TEXT_CACHE_SUFFIX
+    library.save_library()
+    print("Merged {} records".format(total - len(list(library))))
+    for cluster in conflicts:
+        print("Conflicting labels {} shape: {}".format([record.text for record in cluster], cluster[0].image.shape))
+    sizes = {}
+    for record in library:
+        if record.text is not None:
+            sizes.setdefault(record.text, set()).add(record.image.shape)
+    for text, image_sizes in sorted(sizes.items()):
+        if len(image_sizes) > 1:
+            print("'{}' has several sizes: {}".format(text, sorted(image_sizes)))
+    print(str(library))
+    return conflicts
+
+
 def train_symbols(library_path, only_empty=True):
     root = Tk()
     my_gui = TrainGUI(root, library_path, only_empty=only_empty)
@@ -433,5 +1609,30 @@ if __name__ == "__main__":
     parser.add_argument('-l', help='library file', type=str, default='pokerstars_flags.dat')
     parser.add_argument('-ld', help='library dir', type=str, default=settings.PACKAGE_DIR)
     parser.add_argument('-all', help='all images (not only empty)', action='store_true', default=False)
+    parser.add_argument('-convert', help='convert pickled library into packed format', action='store_true',
+                        default=False)
+    parser.add_argument('-quarantine', metavar='DIR', nargs='?', const='', default=None,
+                        help='list unknown images (and save them as <hash>.png into DIR)')
+    parser.add_argument('-promote', metavar=('HASH', 'TEXT'), nargs=2,
+                        help='label unknown image and add it to the library')
+    parser.add_argument('-stats', help='print hits and lookup statistics', action='store_true', default=False)
+    parser.add_argument('-compact', metavar='FILE', nargs='?', const='', default=None,
+                        help='merge near-duplicate records (and save the library into FILE)')
+    parser.add_argument('-matcher', choices=(TEMPLATE_MATCHER, HAMMING_MATCHER), default=TEMPLATE_MATCHER,
+                        help='matcher of near-duplicates for -compact')
+    parser.add_argument('-min_matching', type=float, default=0.98, help='min correlation of template matcher')
+    parser.add_argument('-max_distance', type=int, default=1, help='max differing pixels of hamming matcher')
     args = parser.parse_args()
-    train_symbols(library_path=os.path.join(args.ld, args.l), only_empty= not args.all)
+    if args.convert:
+        print(str(convert_library(os.path.join(args.ld, args.l))))
+    elif args.quarantine is not None:
+        print_quarantine(os.path.join(args.ld, args.l), args.quarantine)
+    elif args.promote:
+        promote_record(os.path.join(args.ld, args.l), *args.promote)
+    elif args.stats:
+        print(ImageLibrary(library_path=os.path.join(args.ld, args.l)).report())
+    elif args.compact is not None:
+        compact_library(os.path.join(args.ld, args.l), os.path.join(args.ld, args.compact) if args.compact else None,
+                        args.matcher, args.min_matching, args.max_distance)
+    else:
+        train_symbols(library_path=os.path.join(args.ld, args.l), only_empty= not args.all)
@@ -0,0 +1,208 @@
+""" Recognition of row batches in worker processes
+
+Every worker loads the libraries from their files, packed libraries are mapped read-only, so the workers share
+their pages. When the scanner loads its libraries again, the workers reload them before the next row.
+Workers don't change the libraries of the scanner: images, that weren't found, are returned with values of the row
+and are looked up in the quarantine of the scanner library in order of rows, so the quarantine, counters and logs
+are the same as after recognition in one process. Hits of found records are returned too and are added
+to the records of the scanner libraries.
+
+Saved list screenshots (e.g. 'row-*.png' of log pictures) can be recognized again:
+
+    python -m scanner.pool log_pictures --pattern "row-*.png" --workers 4
+"""
+import argparse
+import fnmatch
+import json
+import logging
+import multiprocessing
+import os
+import time
+from collections import Counter
+
+from PIL import Image
+
+from scanner import settings
+from scanner import client
+from scanner.client import ListItem, ListRow
+from scanner.logs import configure_logging
+from scanner.metrics import metrics
+from scanner.ocr import ImageLibrary, ImageLogger, PreparedRow, RowBuffers, pil_to_opencv
+from scanner.ocr import FlagDoesNotExist, FlagTextIsNone, CharacterDoesNotExist, CharacterTextIsNone
+
+configure_logging()
+logging.setLoggerClass(ImageLogger)
+log = logging.getLogger(__name__)
+
+_worker_items = {}  # Items of every field set of the worker process
+_worker_field_sets = {}
+_worker_libraries_version = None
+_worker_buffers = RowBuffers()
+
+
+class PoolItem(ListItem):
+    """ Item of a worker, that collects records, that weren't found, instead of logging them """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.unknown = []
+
+    def report(self, exc):
+        is_flag = isinstance(exc, (FlagDoesNotExist, FlagTextIsNone))
+        self.unknown.append((self.name, is_flag, exc.cropped_image, exc.distinguished_image))
+
+
+class PoolLibrary(ImageLibrary):
+    """ Library of a worker, that collects hits of found records to return them to the scanner """
+
+    def __init__(self, *args, **kwargs):
+        self.found = Counter()  # Image key of record to number of hits
+        super().__init__(*args, **kwargs)
+
+    def _count_hit(self, record):
+        super()._count_hit(record)
+        self.found[self._image_key(record.image)] += 1
+
+    def pop_hits(self):
+        """ Return list of (image key, hits, last seen time) of records found since the last call """
+        hits = [(image_key, count, time.time()) for image_key, count in self.found.items()]
+        self.found.clear()
+        return hits
+
+
+def _init_worker(field_sets: dict):
+    _worker_field_sets.update(field_sets)
+
+
+def _load_libraries(libraries_version, library_paths: dict):
+    global _worker_libraries_version
+    client.libraries.clear()
+    for key, library_path in library_paths.items():
+        client.libraries[key] = PoolLibrary(library_path=library_path)
+    for key, fields in _worker_field_sets.items():
+        _worker_items[key] = [PoolItem.from_dict(field) for field in fields]
+    _worker_libraries_version = libraries_version
+
+
+def _recognize_row(task):
+    """ Return values of the row by item name, the records, that weren't found, and hits of found records """
+    key, (libraries_version, library_paths), row_image = task
+    if libraries_version != _worker_libraries_version:
+        _load_libraries(libraries_version, library_paths)
+    items = _worker_items[key]
+    prepared_row = PreparedRow(row_image, _worker_buffers)
+    values = {}
+    unknown = []
+    for item in items:
+        item.unknown = []
+        values[item.name] = item.recognize(prepared_row)
+        unknown.extend(item.unknown)
+    hits = {library_key: library.pop_hits() for library_key, library in client.libraries.items()}
+    return values, unknown, hits
+
+
+class OcrPool:
+    """ Pool of worker processes, that recognize rows of the field sets
+
+    field_sets is dict of key to fields of settings.POKERSTARS (e.g. 'player_fields'),
+    the workers load the libraries from the files of the loaded scanner libraries.
+    """
+
+    def __init__(self, field_sets: dict, processes=settings.OCR_WORKERS):
+        self.field_sets = field_sets
+        self.items = {}
+        self.processes = processes or os.cpu_count()
+        self._libraries = {}
+        self._libraries_version = 0
+        self._library_paths = {}
+        # Spawned workers are the same on all platforms and don't inherit threads of logging and image writer
+        context = multiprocessing.get_context('spawn')
+        self._pool = context.Pool(self.processes, initializer=_init_worker, initargs=(field_sets,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def recognize(self, key, row_images):
+        """ Return list of values of every row by item name in order of rows """
+        if not row_images:
+            return []
+        self._check_libraries()
+        chunk_size = max(1, len(row_images) // (4 * self.processes))
+        results = []
+        with metrics.time('pool_recognize'):
+            libraries_state = (self._libraries_version, self._library_paths)
+            tasks = [(key, libraries_state, row_image) for row_image in row_images]
+            for values, unknown, hits in self._pool.imap(_recognize_row, tasks, chunk_size):
+                for name, is_flag, cropped_image, distinguished_image in unknown:
+                    self._merge_unknown(key, name, is_flag, cropped_image, distinguished_image)
+                for library_key, library_hits in hits.items():
+                    for image_key, count, last_seen in library_hits:
+                        client.libraries[library_key].add_hits(image_key, count, last_seen)
+                results.append(values)
+        return results
+
+    def _check_libraries(self):
+        """ Bind the items to the scanner libraries and make the workers reload them, when they were loaded again """
+        if self._libraries.keys() == client.libraries.keys() and all(
+                library is client.libraries[key] for key, library in self._libraries.items()):
+            return
+        self._libraries = dict(client.libraries)
+        self._libraries_version += 1
+        self._library_paths = {key: library.library_path for key, library in self._libraries.items()}
+        self.items = {key: {item.name: item for item in ListItem.fields_from_dict(fields)}
+                      for key, fields in self.field_sets.items()}
+
+    def _merge_unknown(self, key, name, is_flag, cropped_image, distinguished_image):
+        """ Count the image in the quarantine of the scanner library and report it as the item would """
+        item = self.items[key][name]
+        was_created, _ = item.library.quarantine.get(distinguished_image)
+        if is_flag:
+            exc_class = FlagDoesNotExist if was_created else FlagTextIsNone
+        else:
+            exc_class = CharacterDoesNotExist if was_created else CharacterTextIsNone
+        item.report(exc_class(item.library, cropped_image, distinguished_image))
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+
+def read_rows(directory, row: ListRow, pattern='row-*.png'):
+    """ Return file names and current rows of saved list screenshots, that match the pattern """
+    file_names = []
+    rows = []
+    for file_name in sorted(os.listdir(directory)):
+        if not fnmatch.fnmatch(file_name, pattern):
+            continue
+        with Image.open(os.path.join(directory, file_name)) as image:
+            list_image = pil_to_opencv(image.convert('RGB'))
+        try:
+            rows.append(row.recognizer(list_image, row.zone))
+        except ValueError:
+            log.warning("Can't recognize row in %s", file_name)
+            continue
+        file_names.append(file_name)
+    return file_names, rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Recognize saved row images in worker processes")
+    parser.add_argument('directory', help='directory of list screenshots')
+    parser.add_argument('--pattern', default='row-*.png', help='pattern of file names')
+    parser.add_argument('--list', default='player', choices=('player', 'table'), help='list of the screenshots')
+    parser.add_argument('--workers', type=int, default=settings.OCR_WORKERS, help='number of worker processes')
+    parser.add_argument('--library-dir', dest='library_dir', default=settings.PACKAGE_DIR)
+    args = parser.parse_args()
+    client.Client(library_dir=args.library_dir).load_libraries()
+    fields = '{}_fields'.format(args.list)
+    list_row = ListRow.from_dict(settings.POKERSTARS['{}_list_row'.format(args.list)])
+    names, rows = read_rows(args.directory, list_row, args.pattern)
+    with OcrPool({fields: settings.POKERSTARS[fields]}, processes=args.workers) as pool:
+        for file_name, values in zip(names, pool.recognize(fields, rows)):
+            print(json.dumps(dict(values, file=file_name)))
+    for library in client.libraries.values():
+        library.save_changes()
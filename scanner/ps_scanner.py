@@ -1,6 +1,6 @@
 import datetime
 import json
-import logging.config
+import logging
 import os.path
 import os
 import sys
@@ -8,10 +8,11 @@ from argparse import ArgumentParser
 import time
 
 
-from scanner import settings, ocr, client, sender
+from scanner import settings, ocr, client, sender, replay, logs
+from scanner.metrics import metrics
 
 
-logging.config.dictConfig(settings.LOGGING_CONFIG)
+logs.configure_logging()
 logging.setLoggerClass(ocr.ImageLogger)
 log = logging.getLogger("scanner.ps_scanner")
 
@@ -23,13 +24,17 @@ class Scanner:
                  only_once=False,
                  save_characters=False,
                  save_flags=False,
-                 only_tables=False):
+                 only_tables=False,
+                 replay_dir=None):
         self.save_only = save_only
         if library_dir is None:
             self.library_dir = settings.PACKAGE_DIR
         else:
             self.library_dir = library_dir
-        self.client = client.Client(library_dir=self.library_dir)
+        if replay_dir is None:
+            self.client = client.Client(library_dir=self.library_dir)
+        else:
+            self.client = replay.ReplayClient(replay_dir, library_dir=self.library_dir)
         self.client.prepare()
         self.to_file = True
         self.only_once = only_once
@@ -41,6 +46,10 @@ class Scanner:
         self.only_tables = only_tables
 
     def scan_players(self, table):
+        with metrics.time('scan_players'):
+            return self._scan_players(table)
+
+    def _scan_players(self, table):
         self.client.move_main_window()
         self.client.close_not_main_windows()
         players = []
@@ -58,6 +67,10 @@ class Scanner:
         return unique_players_count, entries_count, players
 
     def scan_tables(self):
+        with metrics.time('scan_tables'):
+            self._scan_tables()
+
+    def _scan_tables(self):
         self.client.move_main_window()
         self.client.close_not_main_windows()
         tables = []
@@ -65,11 +78,8 @@ class Scanner:
         start_datetime = datetime.datetime.now()
         total_player_count = 0
         for table in self.client.table_list:
-            log.debug("Scanning table {}. Plrs: {} Avg Pot: ${} Plrs/Flop: {}".format(table['name'],
-                                                                                      table['player_count'],
-                                                                                      table['average_pot'],
-                                                                                      table['players_per_flop'],
-                                                                                      ))
+            log.debug("Scanning table %s. Plrs: %s Avg Pot: $%s Plrs/Flop: %s", table['name'], table['player_count'],
+                      table['average_pot'], table['players_per_flop'])
             # Some character wasn't recognized
             all_recognized = True
             for key, value in table.items():
@@ -78,12 +88,14 @@ class Scanner:
                     all_recognized = False
             if not all_recognized:
                 log.error("Table '%s' was skipped", table['name'])
+                metrics.count('skipped_tables')
                 continue
             if not self.only_tables and table['player_count'] > 0:
                 unique_players_count, entries_count, players = self.scan_players(table['name'])
                 if not self._is_players_count_almost_equal(table['player_count'], entries_count):
-                    log.warning("Table '{}' has big difference between player count ({}) and entries count ({})".format(
-                        table['name'], table['player_count'], entries_count))
+                    log.warning("Table '%s' has big difference between player count (%s) and entries count (%s)",
+                                table['name'], table['player_count'], entries_count)
+                    metrics.count('skipped_tables')
                     continue
                 table['unique_player_count'] = unique_players_count
                 table['entry_count'] = entries_count
@@ -94,10 +106,10 @@ class Scanner:
                 table['entry_count'] = 0
                 table['players'] = []
             total_player_count += unique_players_count
-            log.debug("Table {} was scaned. Plrs: {} Entrs: {}".format(table['name'],
-                                                                       table['unique_player_count'],
-                                                                       table['entry_count'],
-                                                                       ))
+            metrics.count('tables')
+            metrics.count('players', unique_players_count)
+            log.debug("Table %s was scaned. Plrs: %s Entrs: %s", table['name'], table['unique_player_count'],
+                      table['entry_count'])
             end_datetime = datetime.datetime.now()
             table['datetime'] = end_datetime.isoformat()
             tables.append(table)
@@ -105,7 +117,7 @@ class Scanner:
                 self._handle_scan(tables, start_datetime, end_datetime)
                 total_player_count = 0
                 tables = []
-        log.info("Scanner '{}' has scanned {} tables".format(settings.SCANNER_NAME, len(tables)))
+        log.info("Scanner '%s' has scanned %s tables", settings.SCANNER_NAME, len(tables))
         if tables:
             self._handle_scan(tables, start_datetime, end_datetime)
 
@@ -133,7 +145,10 @@ class Scanner:
                     self.scan_tables()
                 except Exception:
                     log.error("Exception during scan", exc_info=True)
+                    metrics.count('scan_errors')
                 self.client.save_datasets(include=self.library_for_saving)
+                metrics.count('cycles')
+                metrics.dump()
                 if self.only_once:
                     repeat = False
                     break
@@ -141,6 +156,8 @@ class Scanner:
         except KeyboardInterrupt:
             print("You pressed Ctrl+C")
             sys.exit(0)
+        finally:
+            self.client.close()
 
     @staticmethod
     def _is_players_count_almost_equal(players, entries):
@@ -176,6 +193,8 @@ def add_args(parser: ArgumentParser):
     parser.add_argument('--save-flags', dest='save_flags', action='store_true', default=False, help='Save flag library')
     parser.add_argument('--only-tables', '-t', dest='only_tables', action='store_true', default=False,
                         help='Scan only tables')
+    parser.add_argument('--replay', dest='replay_dir', default=None,
+                        help='Replay recorded lobby from the directory instead of scanning PokerStars')
     parser.add_argument('--verbose', action='store_true', default=False, help='Set logging level to "INFO"')
     parser.add_argument('--debug', action='store_true', default=False, help='Set logging level to "DEBUG"')
 
@@ -197,5 +216,6 @@ if __name__ == '__main__':
                     only_once=args.only_once,
                     save_characters=args.save_characters,
                     save_flags=args.save_flags,
-                    only_tables=args.only_tables)
+                    only_tables=args.only_tables,
+                    replay_dir=args.replay_dir)
         s.main_loop()
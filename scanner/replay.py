@@ -0,0 +1,181 @@
+""" Offline replaying of recorded PokerStars lists
+
+A recording of a list is a directory with 'names.txt' (clipboard text of every row, one per line)
+and '<row index>.png' frames (screenshot of the list, when the row is current).
+A recording of the lobby is a directory with 'tables' list recording and 'players/<table row index>'
+list recordings of players of every table.
+"""
+import logging
+import os
+from collections import namedtuple
+
+from PIL import Image
+
+from scanner import settings
+from scanner.logs import configure_logging
+from scanner.client import Client
+from scanner.ocr import ImageLogger
+
+configure_logging()
+logging.setLoggerClass(ImageLogger)
+log = logging.getLogger(__name__)
+
+NAMES_FILE = 'names.txt'
+EMPTY_FRAME_SIZE = (400, 300)  # Size of the black frame of a list without frames
+
+Rectangle = namedtuple('Rectangle', 'left top right bottom')
+
+
+class ReplayClipboard:
+    """ Stand-in for pywinauto.clipboard """
+
+    def __init__(self):
+        self.data = None
+
+    def GetData(self):
+        return self.data
+
+
+class ReplayListControl:
+    """ Stand-in for PokerStars list control, that shows recorded frames """
+
+    def __init__(self, names, frames, clipboard: ReplayClipboard):
+        self.names = names
+        self.frames = frames
+        self.clipboard = clipboard
+        self.position = 0
+        self.captures = 0
+        self.copies = 0
+
+    @classmethod
+    def from_directory(cls, directory, clipboard: ReplayClipboard):
+        names, frames = read_recording(directory)
+        return cls(names, frames, clipboard)
+
+    @property
+    def current_name(self):
+        return self.names[self.position] if self.names else None
+
+    def set_focus(self):
+        pass
+
+    def scroll(self, direction, amount):
+        pass
+
+    def type_keys(self, keys):
+        last_position = max(len(self.names) - 1, 0)
+        if keys == '^{HOME}':
+            self.position = 0
+        elif keys == '^{END}':
+            self.position = last_position
+        elif keys == '{DOWN}':
+            self.position = min(self.position + 1, last_position)
+        elif keys == '{UP}':
+            self.position = max(self.position - 1, 0)
+        elif keys == '^c':
+            self.copies += 1
+            self.clipboard.data = self.current_name
+        else:
+            log.warning("Keys '%s' are ignored by replay", keys)
+
+    def _open_frame(self):
+        """ Open the frame of current row, a list without frames (e.g. of a table without players) is black """
+        frame_path = self.frames.get(self.position)
+        if frame_path is None:
+            return Image.new('RGB', EMPTY_FRAME_SIZE)
+        return Image.open(frame_path)
+
+    def rectangle(self):
+        with self._open_frame() as image:
+            return Rectangle(0, 0, image.width, image.height)
+
+    def capture_as_image(self, rect=None):
+        """ Return the frame of current row or its part in rect """
+        self.captures += 1
+        with self._open_frame() as image:
+            if rect is not None:
+                return image.crop((rect.left, rect.top, rect.right, rect.bottom))
+            image.load()
+            return image
+
+
+class ReplayPlayerListControl(ReplayListControl):
+    """ Player list, that shows recording of players of the current row of table list """
+
+    def __init__(self, table_control: ReplayListControl, players_dir, clipboard: ReplayClipboard):
+        super().__init__([], {}, clipboard)
+        self.table_control = table_control
+        self.players_dir = players_dir
+        self.table_position = None
+
+    def _follow_table(self):
+        if self.table_position != self.table_control.position:
+            self.table_position = self.table_control.position
+            table_dir = os.path.join(self.players_dir, str(self.table_position))
+            if os.path.isdir(table_dir):
+                self.names, self.frames = read_recording(table_dir)
+            else:
+                self.names, self.frames = [], {}
+            self.position = 0
+
+    def set_focus(self):
+        self._follow_table()
+
+    def type_keys(self, keys):
+        self._follow_table()
+        super().type_keys(keys)
+
+    def rectangle(self):
+        self._follow_table()
+        return super().rectangle()
+
+    def capture_as_image(self, rect=None):
+        self._follow_table()
+        return super().capture_as_image(rect)
+
+
+class ReplayWindow:
+    def __init__(self, controls: dict):
+        self.control = controls
+
+
+class ReplayClient(Client):
+    """ Client, that replays recorded lobby instead of running PokerStars """
+
+    def __init__(self, recording_dir, library_dir=None):
+        super().__init__(library_dir=library_dir)
+        self.recording_dir = recording_dir
+        self.clipboard = ReplayClipboard()
+
+    def prepare(self):
+        self.load_libraries()
+        table_control = ReplayListControl.from_directory(os.path.join(self.recording_dir, 'tables'), self.clipboard)
+        player_control = ReplayPlayerListControl(table_control, os.path.join(self.recording_dir, 'players'),
+                                                 self.clipboard)
+        self.main_window = ReplayWindow({settings.POKERSTARS['table_list']: table_control,
+                                         settings.POKERSTARS['player_list']: player_control})
+        self.create_lists(self.main_window, clipboard_source=self.clipboard)
+
+    def connect(self):
+        return True
+
+    def move_main_window(self):
+        pass
+
+    def is_running(self):
+        return True
+
+    def close_not_main_windows(self):
+        pass
+
+
+def read_recording(directory):
+    """ Read names and find frames of list recording """
+    with open(os.path.join(directory, NAMES_FILE), 'r', encoding='utf-8') as file:
+        names = file.read().splitlines()
+    frames = {}
+    for file_name in os.listdir(directory):
+        index, extension = os.path.splitext(file_name)
+        if extension == '.png' and index.isdigit():
+            frames[int(index)] = os.path.join(directory, file_name)
+    return names, frames
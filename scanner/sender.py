@@ -1,13 +1,15 @@
 import requests
 import json
 import datetime
-import logging.config
+import logging
 import os.path
 from argparse import ArgumentParser
 
 from scanner import settings
+from scanner.logs import configure_logging
+from scanner.metrics import metrics
 
-logging.config.dictConfig(settings.LOGGING_CONFIG)
+configure_logging()
 log = logging.getLogger("scanner.sender")
 
 
@@ -15,17 +17,19 @@ def send_scan_result_to_api(scan_result: dict, scan_time: datetime.datetime = No
     successfully = True
     url = settings.API_HOST + settings.API_URL
     try:
-        response = requests.put(url=url,
-                                verify=settings.API_VERIFY_SSL,
-                                data=json.dumps(scan_result),
-                                headers={'content-type': 'application/json'},
-                                auth=(settings.API_USER, settings.API_PASSWORD))
+        with metrics.time('send'):
+            response = requests.put(url=url,
+                                    verify=settings.API_VERIFY_SSL,
+                                    data=json.dumps(scan_result),
+                                    headers={'content-type': 'application/json'},
+                                    auth=(settings.API_USER, settings.API_PASSWORD))
         if not response.ok:
             successfully = False
-            log.error("Response status code is 400. Errors: {}...".format(response.text[:100]))
+            log.error("Response status code is 400. Errors: %s...", response.text[:100])
             response.raise_for_status()
     except requests.RequestException as e:
         successfully = False
+        metrics.count('send_errors')
         if resending:
             log.error("Can't send request.", exc_info=True)
         else:
@@ -45,7 +49,7 @@ def save_scan_result(scan_result: dict, scan_time: datetime.datetime, was_sent=T
         save_dir = settings.JSON_DIR
     file_name = 'scan_{}.json'.format(scan_time.strftime("%Y-%m-%d_%H-%M-%S"))
     try:
-        with open(os.path.join(save_dir, file_name), 'w') as file:
+        with metrics.time('save'), open(os.path.join(save_dir, file_name), 'w') as file:
             json.dump(scan_result, file, indent=4)
     except FileNotFoundError:
         log.error("Can't save json file", exc_info=True)
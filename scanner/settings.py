@@ -1,7 +1,7 @@
 import logging
 import os.path
 
-from decouple import AutoConfig
+from decouple import AutoConfig, Csv
 
 LOG_FILE = 'scan.log'
 LOG_PICTURE_PATH = 'log_pictures'
@@ -17,12 +17,45 @@ config = AutoConfig(search_path=BASE_DIR)
 SCANNER_NAME = config('SCANNER_NAME', default='LOCAL')
 
 LOG_LEVEL = config('LOG_LEVEL', default='WARNING')
+LOG_QUEUE = config('LOG_QUEUE', cast=bool, default=True)  # Run log handlers in a separate thread
 
 JSON_DIR = config('JSON_DIR', default='.\\json')
 JSON_SENT_DIR = config('JSON_SENT_DIR', default='.\\json\sent')
 
 FULL = config('FULL', cast=bool, default=True)
 SENDING_PLAYER_LIMIT = config('SENDING_PLAYER_LIMIT', cast=int, default=50)
+MULTI_ROW = config('MULTI_ROW', cast=bool, default=False)
+# Worker processes, that recognize rows of multi-row screenshots, 0 recognizes them in the scanner process
+OCR_WORKERS = config('OCR_WORKERS', cast=int, default=0)
+# Rows of player list, that are captured ahead of recognition of their items, 0 recognizes them in the walk
+PIPELINE_SIZE = config('PIPELINE_SIZE', cast=int, default=0)
+# Capture only the columns of the lists, that rows and items use
+ROI_CAPTURE = config('ROI_CAPTURE', cast=bool, default=False)
+# A row, that can't be recognized, is read again as soon as the list is repainted.
+# Captures are polled after ROW_RETRY_WAIT seconds, the wait doubles up to ROW_RETRY_MAX_WAIT
+ROW_RETRY_WAIT = config('ROW_RETRY_WAIT', cast=float, default=0.01)
+ROW_RETRY_MAX_WAIT = config('ROW_RETRY_MAX_WAIT', cast=float, default=0.5)
+ROW_RETRY_DEADLINE = config('ROW_RETRY_DEADLINE', cast=float, default=4.0)
+LIBRARY_JOURNAL_LIMIT = config('LIBRARY_JOURNAL_LIMIT', cast=int, default=1000)
+TEXT_CACHE_SIZE = config('TEXT_CACHE_SIZE', cast=int, default=10000)
+TEXT_CACHE_PERSISTENT = config('TEXT_CACHE_PERSISTENT', cast=bool, default=False)
+TEXT_CACHE_PERSISTENT_SIZE = config('TEXT_CACHE_PERSISTENT_SIZE', cast=int, default=100000)
+QUARANTINE_SIZE = config('QUARANTINE_SIZE', cast=int, default=1000)
+# Lookups match the most frequent records of a size first, then the rest
+LIBRARY_HOT_RECORDS = config('LIBRARY_HOT_RECORDS', cast=int, default=32)
+METRICS_FILE = config('METRICS_FILE', default='')
+LOG_PICTURE_QUEUE_SIZE = config('LOG_PICTURE_QUEUE_SIZE', cast=int, default=100)
+LOG_PICTURE_COMPRESSION = config('LOG_PICTURE_COMPRESSION', cast=int, default=1)
+LOG_PICTURE_MAX_SIZE = config('LOG_PICTURE_MAX_SIZE', cast=int, default=500)  # Megabytes
+
+
+def _sampling(value):
+    """ Parse 'row=100,wrong-row=10' into {'row': 100, 'wrong-row': 10} """
+    return {prefix.strip(): int(every) for prefix, every in (item.split('=') for item in Csv()(value))}
+
+
+# Save only every N-th picture of a prefix
+LOG_PICTURE_SAMPLING = config('LOG_PICTURE_SAMPLING', cast=_sampling, default='')
 
 if not os.path.exists(JSON_DIR):
     os.makedirs(JSON_DIR)
@@ -95,18 +128,24 @@ POKERSTARS = {
                       'recognizer': 'recognize_characters',
                       'parser': 'int_parser',
                       'library': 'pokerstars_characters',
+                      'matcher': 'template',
+                      'segmenter': 'contours',
                       },
                      {'name': 'average_pot',
                       'zone': (580, 650),
                       'recognizer': 'recognize_characters',
                       'parser': 'float_parser',
                       'library': 'pokerstars_characters',
+                      'matcher': 'template',
+                      'segmenter': 'contours',
                       },
                      {'name': 'players_per_flop',
                       'zone': (660, 730),
                       'recognizer': 'recognize_characters',
                       'parser': 'int_parser',
                       'library': 'pokerstars_characters',
+                      'matcher': 'template',
+                      'segmenter': 'contours',
                       },
                      ],
     'player_fields': [
@@ -120,13 +159,17 @@ POKERSTARS = {
          'recognizer': 'recognize_characters',
          'parser': 'int_parser',
          'library': 'pokerstars_characters',
+         'matcher': 'template',
+         'segmenter': 'contours',
          },
     ],
     'table_list_row': {'zone': (450, 451),
                        'recognizer': 'recognize_row',
+                       'rows_recognizer': 'recognize_rows',
                        },
     'player_list_row': {'zone': (170, 171),
                         'recognizer': 'recognize_row',
+                        'rows_recognizer': 'recognize_rows',
                         },
     'room': 'PS'
 }
@@ -0,0 +1,200 @@
+""" OCR micro-benchmarks over osr_data
+
+Every benchmark times one stage of the OCR hot path and reports ops/sec and percentiles of a single call
+(in microseconds) as JSON. With --baseline the results are compared with a stored run and the exit code is 1
+if any stage became slower than the tolerance allows.
+
+    python benchmark_osr.py --output baseline.json
+    python benchmark_osr.py --baseline baseline.json --tolerance 0.2
+    python benchmark_osr.py --inflate 20000 -k get_image_record
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from scanner import settings
+from scanner.ocr import (ImageLibrary, TextCache, TABLE_LIST, RowTracker, pil_to_opencv, get_list_zones,
+                         recognize_row, recognize_characters, _distinguish_flag, _find_flag)
+from synthetic_lists import inflate_library
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'osr_data')
+FLAGS_LIBRARY = os.path.join(DATA_DIR, 'flags_test.dat')
+CHARACTERS_LIBRARY = os.path.join(settings.PACKAGE_DIR, 'pokerstars_characters.dat')
+
+ROW_ZONE = (170, 171)
+FLAG_ZONE = (140, 170)
+ENTRIES_ZONE = (190, 220)
+
+PERCENTILES = (50, 90, 99)
+
+
+def _load_image(file_name):
+    with Image.open(os.path.join(DATA_DIR, file_name)) as image:
+        image.load()
+        return image
+
+
+def _list_with_header(pil_image, columns=10):
+    """ Add header stripes of TABLE_LIST columns to the screenshot, as get_list_zones expects them """
+    image = pil_to_opencv(pil_image)
+    header = np.zeros((5, image.shape[1], 3), dtype=np.uint8)
+    for x in np.linspace(0, image.shape[1], columns, endpoint=False, dtype=int):
+        header[:, x + 2:x + 10] = 255
+    return Image.fromarray(np.vstack((image, header)))
+
+
+def _flag_variants(flag_image, count):
+    """ Distinct images, that differ from flag_image in one pixel, so they match it but miss the index """
+    variants = []
+    positions = itertools.product(range(flag_image.shape[0]), range(flag_image.shape[1]), range(flag_image.shape[2]))
+    for y, x, channel in itertools.islice(itertools.cycle(positions), count):
+        variant = flag_image.copy()
+        variant[y, x, channel] ^= 1
+        variants.append(variant)
+    return variants
+
+
+def _load_library(library_path, inflate):
+    library = ImageLibrary(library_path)
+    if inflate:
+        library = inflate_library(library, inflate)
+    return library
+
+
+def build_benchmarks(calls, inflate=0):
+    """ Return dict of benchmark name to function of no arguments
+
+    calls is the number of calls of every function, benchmarks, that need a distinct input per call,
+    prepare so many inputs beforehand. Libraries get inflate near-duplicate records.
+    """
+    players = pil_to_opencv(_load_image('players_1.png'))
+    row = pil_to_opencv(_load_image('row_1.png'))
+    table_list = _list_with_header(_load_image('players_1.png'))
+    tracker = RowTracker()
+    recognize_row(players, ROW_ZONE, tracker)
+
+    flags = _load_library(FLAGS_LIBRARY, inflate)
+    flag_image = _distinguish_flag(row[:, FLAG_ZONE[0]:FLAG_ZONE[1]])
+    flags.get_image_record(flag_image)
+    matching_flags = iter(_flag_variants(flag_image, calls))
+    # Every miss scans all records and adds the image to the quarantine, not to the records, so the scanned records
+    # stay the same, the separate library keeps the quarantine of the other benchmarks empty
+    missing_flags_library = _load_library(FLAGS_LIBRARY, inflate)
+    random = np.random.RandomState(0)
+    missing_flags = iter([random.randint(0, 256, flag_image.shape, dtype=np.uint8) for _ in range(calls)])
+
+    characters = _load_library(CHARACTERS_LIBRARY, inflate)
+    characters.text_cache = TextCache(size=0)
+    cached_characters = _load_library(CHARACTERS_LIBRARY, inflate)
+
+    return {
+        'get_list_zones': lambda: get_list_zones(table_list, ps_list=TABLE_LIST),
+        'recognize_row': lambda: recognize_row(players, ROW_ZONE),
+        'recognize_row_tracked': lambda: recognize_row(players, ROW_ZONE, tracker),
+        '_distinguish_flag': lambda: _distinguish_flag(row[:, FLAG_ZONE[0]:FLAG_ZONE[1]]),
+        '_find_flag': lambda: _find_flag(next(matching_flags), flags),
+        'recognize_characters': lambda: recognize_characters(row, ENTRIES_ZONE, characters),
+        'recognize_characters_cached': lambda: recognize_characters(row, ENTRIES_ZONE, cached_characters),
+        'get_image_record_hit': lambda: flags.get_image_record(flag_image),
+        'get_image_record_match': lambda: flags.get_image_record(next(matching_flags)),
+        'get_image_record_miss': lambda: missing_flags_library.get_image_record(next(missing_flags)),
+    }
+
+
+def measure(function, iterations, warmup):
+    """ Time single calls of the function and return statistics in microseconds """
+    for _ in range(warmup):
+        function()
+    timings = np.empty(iterations)
+    for i in range(iterations):
+        start = time.perf_counter()
+        function()
+        timings[i] = time.perf_counter() - start
+    timings *= 1e6
+    stats = {
+        'iterations': iterations,
+        'ops_per_sec': iterations / (timings.sum() / 1e6),
+        'mean_us': timings.mean(),
+        'min_us': timings.min(),
+        'max_us': timings.max(),
+    }
+    for percentile, value in zip(PERCENTILES, np.percentile(timings, PERCENTILES)):
+        stats['p{}_us'.format(percentile)] = value
+    return {key: float(value) if key != 'iterations' else value for key, value in stats.items()}
+
+
+def run(iterations=200, warmup=20, names=None, inflate=0):
+    # _find_flag and get_image_record_match draw from the same variants
+    benchmarks = build_benchmarks(2 * (iterations + warmup), inflate=inflate)
+    results = {}
+    for name, function in benchmarks.items():
+        if names and not any(part in name for part in names):
+            continue
+        results[name] = measure(function, iterations, warmup)
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'machine': platform.machine(),
+            'system': platform.system(),
+            'inflate': inflate,
+        },
+        'benchmarks': results,
+    }
+
+
+def compare(results, baseline, tolerance=0.2):
+    """ Return list of (name, baseline ops/sec, current ops/sec) for benchmarks, that are slower than tolerance """
+    regressions = []
+    for name, stats in results['benchmarks'].items():
+        baseline_stats = baseline['benchmarks'].get(name)
+        if baseline_stats is None:
+            continue
+        if stats['ops_per_sec'] < baseline_stats['ops_per_sec'] * (1 - tolerance):
+            regressions.append((name, baseline_stats['ops_per_sec'], stats['ops_per_sec']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OCR micro-benchmarks")
+    parser.add_argument('--iterations', '-n', type=int, default=200, help='timed calls per benchmark')
+    parser.add_argument('--warmup', type=int, default=20, help='untimed calls per benchmark')
+    parser.add_argument('--filter', '-k', dest='names', nargs='*', default=None,
+                        help='run only benchmarks, which names contain any of the strings')
+    parser.add_argument('--inflate', type=int, default=0,
+                        help='add so many near-duplicate records to every library')
+    parser.add_argument('--output', '-o', default=None, help='write JSON results to the file instead of stdout')
+    parser.add_argument('--baseline', '-b', default=None, help='JSON results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative loss of ops/sec against the baseline')
+    args = parser.parse_args()
+
+    results = run(iterations=args.iterations, warmup=args.warmup, names=args.names, inflate=args.inflate)
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, tolerance=args.tolerance)
+        for name, baseline_ops, ops in regressions:
+            print("{}: {:.1f} ops/sec, baseline {:.1f} ops/sec".format(name, ops, baseline_ops), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
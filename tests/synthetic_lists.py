@@ -0,0 +1,211 @@
+""" Synthetic PokerStars lists for scaling tests
+
+Lists are composed of glyphs and flags of existing image libraries, placed in the zones of
+settings.POKERSTARS['table_fields'] and ['player_fields'], so the rendered text is the ground truth.
+Rendered lists are written as replay recordings (see scanner.replay) with 'truth.json' next to them:
+
+    python synthetic_lists.py recording_dir --tables 5 --players 2000
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+from PIL import Image
+
+from scanner import settings
+from scanner.ocr import ImageLibrary, ImageRecord
+from scanner.replay import NAMES_FILE
+
+TRUTH_FILE = 'truth.json'
+
+ROW_HEIGHT = 21
+VISIBLE_ROWS = 20
+PLAYER_LIST_WIDTH = 242
+TABLE_LIST_WIDTH = 760
+
+BASELINE = 15  # Bottom row of glyphs
+GLYPH_GAP = 1
+SPACE_GAP = 5
+TEXT_OFFSET = 2
+
+BACKGROUND = 240
+TEXT = 0
+CURRENT_BACKGROUND = 120
+CURRENT_TEXT = 255
+
+
+def load_libraries(library_dir=settings.PACKAGE_DIR):
+    """ Load libraries of settings.POKERSTARS by their names """
+    return {name: ImageLibrary(os.path.join(library_dir, file_name))
+            for name, file_name in settings.POKERSTARS['libraries'].items()}
+
+
+def _glyphs(library: ImageLibrary):
+    """ Return dict of text to image of named records, the most hit record wins """
+    glyphs = {}
+    hits = {}
+    for record in library:
+        if record.text is not None and record.hits >= hits.get(record.text, -1):
+            glyphs[record.text] = record.image
+            hits[record.text] = record.hits
+    return glyphs
+
+
+class ListRenderer:
+    """ Render rows of a PokerStars list from field values """
+
+    def __init__(self, fields, libraries: dict, width, row_height=ROW_HEIGHT, visible_rows=VISIBLE_ROWS):
+        self.fields = [field for field in fields if field['recognizer'] in ('recognize_characters', 'recognize_flag')]
+        self.glyphs = {field['library']: _glyphs(libraries[field['library']]) for field in self.fields}
+        self.width = width
+        self.row_height = row_height
+        self.visible_rows = visible_rows
+
+    def render_text(self, row, zone, text, glyphs, color):
+        x = zone[0] + TEXT_OFFSET
+        for character in text:
+            if character == ' ':
+                x += SPACE_GAP - GLYPH_GAP
+                continue
+            try:
+                glyph = glyphs[character]
+            except KeyError:
+                raise ValueError("Library has no glyph of '{}'".format(character)) from None
+            height, width = glyph.shape
+            if x + width > zone[1]:
+                raise ValueError("Text '{}' doesn't fit zone {}".format(text, zone))
+            top = max(BASELINE + 1 - height, 0)
+            area = row[top:top + height, x:x + width]
+            area[glyph[:area.shape[0]] > 0] = color
+            x += width + GLYPH_GAP
+
+    def render_flag(self, row, zone, country, flags):
+        flag = flags[country]
+        height, width, _ = flag.shape
+        top = (self.row_height - height) // 2
+        left = zone[0] + (zone[1] - zone[0] - width) // 2
+        row[top:top + height, left:left + width] = flag
+
+    def render_row(self, values: dict, current=False):
+        """ Return RGB image of the row with values of fields by field name """
+        background, color = (CURRENT_BACKGROUND, CURRENT_TEXT) if current else (BACKGROUND, TEXT)
+        row = np.full((self.row_height, self.width, 3), background, dtype=np.uint8)
+        for field in self.fields:
+            value = values.get(field['name'])
+            if value is None:
+                continue
+            glyphs = self.glyphs[field['library']]
+            if field['recognizer'] == 'recognize_flag':
+                self.render_flag(row, field['zone'], value, glyphs)
+            else:
+                self.render_text(row, field['zone'], str(value), glyphs, color)
+        return row
+
+    def top_row(self, row_count, position):
+        """ Index of the first visible row, when the row at position is current """
+        return max(0, min(position - self.visible_rows + 1, row_count - self.visible_rows))
+
+    def render_list(self, rows: list, position):
+        """ Return RGB image of the visible part of the list, when the row at position is current """
+        top = self.top_row(len(rows), position)
+        images = [self.render_row(values, current=index == position)
+                  for index, values in enumerate(rows[top:top + self.visible_rows], start=top)]
+        empty_rows = self.visible_rows - len(images)
+        if empty_rows > 0:
+            images.append(np.full((empty_rows * self.row_height, self.width, 3), BACKGROUND, dtype=np.uint8))
+        return np.vstack(images)
+
+    def write_recording(self, directory, rows: list):
+        """ Write rows with 'name' values as replay recording of the list """
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, NAMES_FILE), 'w', encoding='utf-8') as file:
+            file.write('\n'.join(values['name'] for values in rows))
+        for position in range(len(rows)):
+            image = Image.fromarray(self.render_list(rows, position))
+            image.save(os.path.join(directory, '{}.png'.format(position)))
+
+
+def random_values(fields, libraries: dict, random: np.random.RandomState):
+    """ Return dict of random values, that can be rendered, by field name """
+    values = {}
+    for field in fields:
+        if field['recognizer'] == 'recognize_flag':
+            countries = sorted(text for text in _glyphs(libraries[field['library']]))
+            values[field['name']] = countries[random.randint(len(countries))]
+        elif field['recognizer'] == 'recognize_characters':
+            number = str(random.randint(1, 10 ** random.randint(1, 4)))
+            if field.get('parser') == 'float_parser':
+                number = '{}.{:02d}'.format(number, random.randint(100))
+            values[field['name']] = number
+    return values
+
+
+def random_lobby(table_count, player_count, libraries: dict, seed=0):
+    """ Return list of tables with random values, every table has 'players' list """
+    random = np.random.RandomState(seed)
+    tables = []
+    for table_index in range(table_count):
+        table = random_values(settings.POKERSTARS['table_fields'], libraries, random)
+        table['name'] = 'Table {}'.format(table_index)
+        table['players'] = []
+        for player_index in range(player_count):
+            player = random_values(settings.POKERSTARS['player_fields'], libraries, random)
+            player['name'] = 'player_{}_{}'.format(table_index, player_index)
+            table['players'].append(player)
+        tables.append(table)
+    return tables
+
+
+def write_lobby(directory, tables: list, libraries: dict):
+    """ Write tables of random_lobby as replay recording of the lobby with ground truth """
+    table_renderer = ListRenderer(settings.POKERSTARS['table_fields'], libraries, width=TABLE_LIST_WIDTH)
+    player_renderer = ListRenderer(settings.POKERSTARS['player_fields'], libraries, width=PLAYER_LIST_WIDTH)
+    table_renderer.write_recording(os.path.join(directory, 'tables'), tables)
+    for index, table in enumerate(tables):
+        player_renderer.write_recording(os.path.join(directory, 'players', str(index)), table['players'])
+    with open(os.path.join(directory, TRUTH_FILE), 'w', encoding='utf-8') as file:
+        json.dump(tables, file, indent=2)
+
+
+def inflate_library(library: ImageLibrary, count, changed_pixels=1, seed=0):
+    """ Return new library with the records of the library and count near-duplicates of its named records
+
+    A near-duplicate is a copy of a record, that differs from it in changed_pixels pixels and has the same text.
+    Fewer near-duplicates are added, if the records don't have so many distinct ones.
+    """
+    random = np.random.RandomState(seed)
+    records = {}
+    seen = set()
+    for record in library:
+        records.setdefault(record.image.shape, []).append(ImageRecord(record.image, record.text))
+        seen.add((record.image.shape, record.image.tobytes()))
+    originals = [record for record in library if record.text is not None]
+    added = 0
+    attempts = 0
+    while added < count and originals and attempts < 100 * count:
+        attempts += 1
+        original = originals[random.randint(len(originals))]
+        image = original.image.copy()
+        flat = image.reshape(-1)
+        pixels = random.choice(flat.size, min(changed_pixels, flat.size), replace=False)
+        flat[pixels] = 255 - flat[pixels]
+        key = (image.shape, image.tobytes())
+        if key in seen:
+            continue
+        seen.add(key)
+        records[image.shape].append(ImageRecord(image, original.text))
+        added += 1
+    return ImageLibrary(records=records)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Synthetic PokerStars lobby recording")
+    parser.add_argument('directory', help='recording directory')
+    parser.add_argument('--tables', type=int, default=3, help='number of tables')
+    parser.add_argument('--players', type=int, default=20, help='number of players of every table')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--library-dir', dest='library_dir', default=settings.PACKAGE_DIR)
+    args = parser.parse_args()
+    libraries = load_libraries(args.library_dir)
+    write_lobby(args.directory, random_lobby(args.tables, args.players, libraries, seed=args.seed), libraries)
@@ -1,10 +1,14 @@
+import sys
 import unittest
+from unittest import mock
 
 import numpy as np
 from PIL import Image
 
 from scanner.client import *
+from scanner.metrics import metrics
 from scanner.ocr import *
+from scanner.replay import ReplayClipboard, ReplayListControl, ReplayWindow
 
 players_img_1 = pil_to_opencv(Image.open('osr_data/players_1.png'))
 players_img_2 = pil_to_opencv(Image.open('osr_data/players_2.png'))
@@ -90,7 +94,261 @@ class ListItemTest(unittest.TestCase):
 
 
 class ClientListTest(unittest.TestCase):
-    pass
+    def setUp(self):
+        self.clipboard = ReplayClipboard()
+        self.control = ReplayListControl(['AKA_SDK', 'Andrecgb', 'ascentrian'],
+                                         {i: 'osr_data/players_{}.png'.format(i + 1) for i in range(3)},
+                                         self.clipboard)
+        self.window = ReplayWindow({'PokerStarsList2': self.control})
+        library = ImageLibrary(library_path=os.path.join(settings.PACKAGE_DIR, 'pokerstars_characters.dat'))
+        self.items = [ListItem('entries', zone=(190, 220), recognizer=recognize_characters, parser=int_parser,
+                               library=library)]
+        self.row = ListRow(recognizer=recognize_row, zone=(170, 171), rows_recognizer=recognize_rows)
+
+    def test_iter(self):
+        player_list = ClientList(self.window, 'PokerStarsList2', row=self.row, items=self.items,
+                                 clipboard_source=self.clipboard)
+        self.assertEqual(list(player_list), [{'name': 'AKA_SDK', 'entries': 2},
+                                             {'name': 'Andrecgb', 'entries': 3},
+                                             {'name': 'ascentrian', 'entries': 1}])
+
+    def test_iter_empty_recording(self):
+        control = ReplayListControl([], {}, self.clipboard)
+        for multi_row in (False, True):
+            player_list = ClientList(ReplayWindow({'PokerStarsList2': control}), 'PokerStarsList2', row=self.row,
+                                     items=self.items, multi_row=multi_row, clipboard_source=self.clipboard)
+            with mock.patch('scanner.settings.ROW_RETRY_DEADLINE', 0.05):
+                self.assertEqual(list(player_list), [])
+
+    def test_iter_reads(self):
+        player_list = ClientList(self.window, 'PokerStarsList2', row=self.row, items=self.items,
+                                 clipboard_source=self.clipboard)
+        metrics.reset()
+        self.assertEqual([player['name'] for player in player_list], ['AKA_SDK', 'Andrecgb', 'ascentrian'])
+        # One copy and one capture per row, the end of the list is told by the unchanged last row
+        self.assertEqual(self.control.copies, 4)
+        self.assertEqual(self.control.captures, 4)
+        self.assertEqual(metrics.histograms['field_entries'].count, 3)
+        self.assertFalse(metrics.counters)
+
+    def test_iter_lagging_list(self):
+        class LaggingControl(ReplayListControl):
+            """ The first capture after a move shows the previous row """
+            lagging_position = None
+
+            def type_keys(self, keys):
+                self.lagging_position = self.position
+                super().type_keys(keys)
+
+            def capture_as_image(self):
+                if self.lagging_position is None:
+                    return super().capture_as_image()
+                position, self.position, self.lagging_position = self.position, self.lagging_position, None
+                try:
+                    return super().capture_as_image()
+                finally:
+                    self.position = position
+
+        control = LaggingControl(self.control.names, self.control.frames, self.clipboard)
+        player_list = ClientList(ReplayWindow({'PokerStarsList2': control}), 'PokerStarsList2', row=self.row,
+                                 items=self.items, clipboard_source=self.clipboard)
+        with mock.patch('scanner.settings.ROW_RETRY_DEADLINE', 0.05):
+            self.assertEqual(list(player_list), [{'name': 'AKA_SDK', 'entries': 2},
+                                                 {'name': 'Andrecgb', 'entries': 3},
+                                                 {'name': 'ascentrian', 'entries': 1}])
+
+    def test_iter_live_last_row(self):
+        class LiveControl(ReplayListControl):
+            """ Values of the last row change on every capture """
+
+            def capture_as_image(self, rect=None):
+                image = super().capture_as_image(rect)
+                if self.position < len(self.names) - 1:
+                    return image
+                pixels = np.array(image.convert('RGB'))
+                pixels[:, 0] = self.captures % 256
+                return Image.fromarray(pixels)
+
+        control = LiveControl(self.control.names, self.control.frames, self.clipboard)
+        player_list = ClientList(ReplayWindow({'PokerStarsList2': control}), 'PokerStarsList2', row=self.row,
+                                 items=self.items, clipboard_source=self.clipboard)
+        self.assertEqual(list(player_list), [{'name': 'AKA_SDK', 'entries': 2},
+                                             {'name': 'Andrecgb', 'entries': 3},
+                                             {'name': 'ascentrian', 'entries': 1}])
+        # The unchanged name ends the list after one more move
+        self.assertEqual(control.copies, 5)
+
+    def test_iter_same_rows(self):
+        class SameRowControl(ReplayListControl):
+            """ The second row has the same pixels as the first one, only the rest of the list differs """
+
+            def capture_as_image(self, rect=None):
+                image = super().capture_as_image(rect)
+                if self.position != 1:
+                    return image
+                pixels = np.array(image.convert('RGB'))
+                pixels[-1] = 255
+                return Image.fromarray(pixels)
+
+        control = SameRowControl(['AKA_SDK', 'AKA_SDK 2', 'Andrecgb'],
+                                 {0: 'osr_data/players_1.png', 1: 'osr_data/players_1.png',
+                                  2: 'osr_data/players_2.png'}, self.clipboard)
+        player_list = ClientList(ReplayWindow({'PokerStarsList2': control}), 'PokerStarsList2', row=self.row,
+                                 items=self.items, clipboard_source=self.clipboard)
+        metrics.reset()
+        self.assertEqual(list(player_list), [{'name': 'AKA_SDK', 'entries': 2},
+                                             {'name': 'AKA_SDK 2', 'entries': 2},
+                                             {'name': 'Andrecgb', 'entries': 3}])
+        # The row with the same pixels isn't recognized again
+        self.assertEqual(metrics.histograms['field_entries'].count, 2)
+
+    def test_iter_unreadable_row(self):
+        frames = dict(self.control.frames)
+        frames[1] = 'osr_data/players_empty_list.png'  # The row of Andrecgb can't be found
+        control = ReplayListControl(self.control.names, frames, self.clipboard)
+        for pipeline_size in (0, 2):
+            player_list = ClientList(ReplayWindow({'PokerStarsList2': control}), 'PokerStarsList2', row=self.row,
+                                     items=self.items, clipboard_source=self.clipboard, pipeline_size=pipeline_size)
+            metrics.reset()
+            with mock.patch('scanner.settings.ROW_RETRY_DEADLINE', 0.05), mock.patch('scanner.client.log.error'):
+                self.assertEqual(list(player_list), [{'name': 'AKA_SDK', 'entries': 2},
+                                                     {'name': 'Andrecgb', 'entries': None},
+                                                     {'name': 'ascentrian', 'entries': 1}])
+            # No repaint is waited for after the last attempt
+            self.assertEqual(metrics.counters['row_retries'], ROW_ATTEMPTS - 1)
+            self.assertEqual(metrics.histograms['row_retry_wait'].count, ROW_ATTEMPTS - 1)
+
+    def test_list_capture(self):
+        capture = ListCapture.from_zones(self.control, self.row, self.items)
+        self.assertEqual(capture.spans, [(170, 171), (190, 220)])
+        with mock.patch.object(self.control, 'capture_as_image', wraps=self.control.capture_as_image) as capture_image:
+            image = capture.capture()
+        # Only the columns of the zones are captured
+        rects = [call[1]['rect'] for call in capture_image.call_args_list]
+        self.assertEqual([(rect.left, rect.right) for rect in rects], capture.spans)
+        self.assertEqual(image.shape, players_img_1.shape)
+        for left, right in capture.spans:
+            np.testing.assert_array_equal(image[:, left:right], players_img_1[:, left:right])
+        self.assertFalse(image[:, :170].any())
+        self.assertFalse(image[:, 171:190].any())
+        self.assertFalse(image[:, 220:].any())
+        self.control.type_keys('{DOWN}')
+        self.assertIs(capture.capture(), image)
+        np.testing.assert_array_equal(image[:, 190:220], players_img_2[:, 190:220])
+
+        row = ListRow.from_dict(settings.POKERSTARS['player_list_row'])
+        items = [ListItem(field['name'], zone=field['zone'], recognizer=recognize_characters)
+                 for field in settings.POKERSTARS['player_fields']]
+        capture = ListCapture.from_zones(self.control, row, items)
+        # The flag zone and the row zone are adjacent
+        self.assertEqual(capture.spans, [(140, 171), (190, 220)])
+
+    def test_iter_roi_capture(self):
+        player_list = ClientList(self.window, 'PokerStarsList2', row=self.row, items=self.items,
+                                 clipboard_source=self.clipboard, roi_capture=True)
+        self.assertEqual(list(player_list), [{'name': 'AKA_SDK', 'entries': 2},
+                                             {'name': 'Andrecgb', 'entries': 3},
+                                             {'name': 'ascentrian', 'entries': 1}])
+        self.assertIs(player_list.image, player_list.capture.buffer)
+
+    def test_iter_multi_row(self):
+        player_list = ClientList(self.window, 'PokerStarsList2', row=self.row, items=self.items, multi_row=True,
+                                 clipboard_source=self.clipboard)
+        self.assertEqual(list(player_list), [{'name': 'AKA_SDK', 'entries': 2},
+                                             {'name': 'Andrecgb', 'entries': 3},
+                                             {'name': 'ascentrian', 'entries': 1}])
+        self.assertEqual(self.control.captures, 1)
+
+    def test_iter_metrics(self):
+        metrics.reset()
+        player_list = ClientList(self.window, 'PokerStarsList2', row=self.row, items=self.items,
+                                 clipboard_source=self.clipboard)
+        list(player_list)
+        captures = metrics.histograms['capture'].count
+        self.assertEqual(captures, self.control.captures)
+        # The last capture only tells the end of the list
+        self.assertEqual(metrics.histograms['recognize_row'].count, captures - 1)
+        self.assertEqual(metrics.histograms['field_entries'].count, captures - 1)
+        self.assertGreater(metrics.histograms['keys'].count, 3)
+        self.assertFalse(metrics.counters)
+
+    def test_wait_for_repaint(self):
+        empty_list = Image.open('osr_data/players_empty_list.png')
+        frames = [empty_list, empty_list]  # The list is repainted after the second capture
+
+        class RepaintingControl(ReplayListControl):
+            def capture_as_image(self):
+                if frames:
+                    self.captures += 1
+                    return frames.pop()
+                return super().capture_as_image()
+
+        control = RepaintingControl(self.control.names, self.control.frames, self.clipboard)
+        player_list = ClientList(ReplayWindow({'PokerStarsList2': control}), 'PokerStarsList2', row=self.row,
+                                 items=self.items, clipboard_source=self.clipboard)
+        metrics.reset()
+        self.assertEqual(list(player_list)[0], {'name': 'AKA_SDK', 'entries': 2})
+        self.assertEqual(metrics.counters['row_retries'], 1)
+        self.assertEqual(metrics.histograms['row_retry_wait'].count, 1)
+        self.assertLess(metrics.histograms['row_retry_wait'].sum, 1)
+
+        frames.extend([empty_list] * 100)
+        player_list.capture_as_image()
+        with mock.patch('scanner.settings.ROW_RETRY_DEADLINE', 0.05):
+            self.assertFalse(player_list.wait_for_repaint())
+        self.assertEqual(metrics.counters['row_retry_timeouts'], 1)
+
+    def test_iter_pipelined(self):
+        for pipeline_size in (1, 3):
+            player_list = ClientList(self.window, 'PokerStarsList2', row=self.row, items=self.items,
+                                     clipboard_source=self.clipboard, pipeline_size=pipeline_size)
+            self.assertEqual(list(player_list), [{'name': 'AKA_SDK', 'entries': 2},
+                                                 {'name': 'Andrecgb', 'entries': 3},
+                                                 {'name': 'ascentrian', 'entries': 1}])
+            self.assertIsNone(player_list.pipeline)
+
+    def test_pipeline_metrics(self):
+        # Both threads record metrics at the same time
+        def recognizer(*args):
+            metrics.count('recognized')
+            metrics.observe('field_recognized_{}'.format(metrics.counters['recognized'] % 7), 0.001)
+
+        rows = 2000
+        items = [ListItem('value', recognizer=recognizer) for _ in range(3)]
+        pipeline = RowPipeline(items, size=10)
+        metrics.reset()
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)  # Switch threads as often as possible
+        try:
+            for _ in range(rows):
+                pipeline.put(row_img_1)
+                metrics.count('put')
+            row_id = pipeline.put(row_img_1)
+            pipeline.get(row_id)
+        finally:
+            sys.setswitchinterval(switch_interval)
+            pipeline.close()
+        self.assertEqual(metrics.counters['put'], rows)
+        self.assertEqual(metrics.counters['recognized'], 3 * (rows + 1))
+        self.assertEqual(metrics.histograms['pipeline_put'].count, rows + 1)
+        self.assertEqual(sum(histogram.count for stage, histogram in metrics.histograms.items()
+                             if stage.startswith('field_')), 2 * 3 * (rows + 1))
+
+    def test_row_pipeline(self):
+        row_image = recognize_row(players_img_1, zone=(170, 171))
+        pipeline = RowPipeline(self.items, size=2)
+        pipeline.put(row_image)
+        second_id = pipeline.put(row_image)
+        self.assertEqual(pipeline.get(second_id), {'entries': 2})
+        self.assertTrue(pipeline.is_ready(None))
+        self.assertFalse(pipeline._done)
+        pipeline.close()
+
+        pipeline = RowPipeline([ListItem('broken', recognizer=lambda *args: 1 / 0)], size=1)
+        row_id = pipeline.put(row_image)
+        with self.assertRaises(ZeroDivisionError):
+            pipeline.get(row_id)
+        pipeline.close()
 
 
 class ParsersTest(unittest.TestCase):
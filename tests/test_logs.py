@@ -0,0 +1,38 @@
+import io
+import logging.handlers
+import unittest
+
+from scanner.logs import queue_handlers
+
+
+class QueueHandlersTest(unittest.TestCase):
+    def make_logger(self, name):
+        stream = io.StringIO()
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(logging.Formatter('%(name)s - %(levelname)s - %(message)s'))
+        handler.setLevel(logging.INFO)
+        logger = logging.getLogger(name)
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(handler)
+        return logger, stream
+
+    def log(self, logger):
+        logger.debug("Hidden %s", 1)
+        logger.info("Table %s was scanned. Plrs: %s", 'Aludra', 6)
+        try:
+            raise ValueError("Can't recognize row")
+        except ValueError:
+            logger.error("Exception during scan", exc_info=True)
+
+    def test_queue_handlers(self):
+        direct_logger, direct_stream = self.make_logger('test_logs.direct')
+        queued_logger, queued_stream = self.make_logger('test_logs.queued')
+        listener = queue_handlers(queued_logger)
+        self.assertEqual([type(handler) for handler in queued_logger.handlers], [logging.handlers.QueueHandler])
+        self.log(direct_logger)
+        self.log(queued_logger)
+        listener.stop()
+        self.assertIn("Traceback", queued_stream.getvalue())
+        self.assertEqual(queued_stream.getvalue().replace('test_logs.queued', 'test_logs.direct'),
+                         direct_stream.getvalue())
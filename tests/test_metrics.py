@@ -0,0 +1,59 @@
+import json
+import os
+import tempfile
+import unittest
+
+from scanner.metrics import *
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_observe(self):
+        self.metrics.observe('capture', 0.002)
+        self.metrics.observe('capture', 0.02)
+        self.metrics.observe('capture', 100)
+        histogram = self.metrics.histograms['capture']
+        self.assertEqual(histogram.count, 3)
+        self.assertAlmostEqual(histogram.sum, 100.022)
+        self.assertEqual(histogram.counts[BUCKETS.index(0.0025)], 1)
+        self.assertEqual(histogram.counts[BUCKETS.index(0.025)], 1)
+        self.assertEqual(histogram.counts[-1], 1)
+        self.assertEqual(list(histogram.cumulative_counts())[-1], 3)
+
+    def test_time(self):
+        with self.assertRaises(ValueError):
+            with self.metrics.time('recognize_row'):
+                raise ValueError
+        self.assertEqual(self.metrics.histograms['recognize_row'].count, 1)
+
+    def test_to_prometheus(self):
+        self.metrics.observe('keys', 0.001)
+        self.metrics.count('row_retries')
+        self.metrics.count('row_retries')
+        text = self.metrics.to_prometheus()
+        self.assertIn('scanner_stage_seconds_bucket{stage="keys",le="0.001"} 1\n', text)
+        self.assertIn('scanner_stage_seconds_bucket{stage="keys",le="0.0005"} 0\n', text)
+        self.assertIn('scanner_stage_seconds_bucket{stage="keys",le="+Inf"} 1\n', text)
+        self.assertIn('scanner_stage_seconds_count{stage="keys"} 1\n', text)
+        self.assertIn('scanner_row_retries_total 2\n', text)
+
+    def test_dump(self):
+        self.metrics.observe('keys', 0.001)
+        self.metrics.count('skipped_tables')
+        directory = tempfile.mkdtemp()
+        json_path = os.path.join(directory, 'metrics.json')
+        prom_path = os.path.join(directory, 'metrics.prom')
+        self.metrics.dump(json_path)
+        self.metrics.dump(prom_path)
+        with open(json_path) as file:
+            dumped = json.load(file)
+        self.assertEqual(dumped['stages']['keys']['count'], 1)
+        self.assertEqual(dumped['counters'], {'skipped_tables': 1})
+        with open(prom_path) as file:
+            self.assertEqual(file.read(), self.metrics.to_prometheus())
+        self.assertEqual(sorted(os.listdir(directory)), ['metrics.json', 'metrics.prom'])
+        os.remove(json_path)
+        os.remove(prom_path)
+        os.rmdir(directory)
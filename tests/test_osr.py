@@ -1,9 +1,25 @@
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
 import unittest
+from unittest import mock
 
+import cv2
 import numpy as np
 from PIL import Image
 from scanner.ocr import _has_intersection, _unite_intersected, _get_united, _distinguish_flag, _find_flag
-from scanner.ocr import ImageRecord, recognize_row, recognize_characters, recognize_flag
+from scanner.ocr import _segment_by_contours, _segment_by_projection
+from scanner.ocr import ImageRecord, recognize_row, recognize_rows, recognize_characters, recognize_flag, HAMMING_MATCHER
+from scanner.ocr import PROJECTION_SEGMENTER
+from scanner.ocr import convert_library, LIBRARY_MAGIC, JOURNAL_SUFFIX, TEXT_CACHE_SUFFIX, TextCache, PreparedRow, RowBuffers
+from scanner.ocr import ImageWriter, ImageLogger, ImageStore, Quarantine, QUARANTINE_SUFFIX, _digest
+from scanner.ocr import HITS_SUFFIX, HOT_STAGE, FULL_STAGE, INDEX_STAGE, MISS_STAGE
+from scanner.ocr import RowTracker
+from scanner.metrics import metrics
+from scanner.ocr import cluster_images, compact_library
 
 from scanner.client import *
 
@@ -91,13 +107,93 @@ class ImageLibraryTest(unittest.TestCase):
                                  [255, 0, 0, 0, 0, 255],
                                  [0, 255, 255, 255, 255, 0]], dtype=np.uint8)
 
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, file_name):
+        return os.path.join(self.directory, file_name)
+
     def test_save_load(self):
-        sd = ImageLibrary('symbols_test.dat')
-        sd.records = {'pu': 'tu'}
+        library_path = self.path('symbols_test.dat')
+        sd = ImageLibrary(library_path)
+        sd.records = {(10, 6): [ImageRecord(self.img_of_2, '2', hits=5), ImageRecord(self.img_of_3, None)],
+                      (16, 22, 3): [ImageRecord(rus_array, 'rus')]}
         sd.save_library()
-        sd2 = ImageLibrary('symbols_test.dat')
+        sd2 = ImageLibrary(library_path)
         sd2.load_library()
-        self.assertEqual(sd2.records['pu'], 'tu')
+        # Unnamed record is moved into the quarantine
+        self.assertEqual(sd2.records[(10, 6)], [ImageRecord(self.img_of_2, '2')])
+        self.assertEqual(list(sd2.quarantine), [ImageRecord(self.img_of_3, None)])
+        self.assertEqual(sd2.records[(10, 6)][0].hits, 5)
+        self.assertEqual(sd2.records[(16, 22, 3)], [ImageRecord(rus_array, 'rus')])
+        was_created, symbol_record = sd2.get_image_record(self.img_of_3)
+        self.assertFalse(was_created)
+        sd2.get_image_record(np.eye(10, 6, dtype=np.uint8) * 255)
+        sd2.save_library()
+        self.assertEqual(len([r for r in ImageLibrary(library_path)]), 4)
+
+    def test_journal(self):
+        library_path = self.path('journal_test.dat')
+        il = ImageLibrary(library_path)
+        _, record_of_2 = il.get_image_record(self.img_of_2)
+        il.get_image_record(self.img_of_3)
+        il.relabel(record_of_2, '2')
+        il.save_changes()
+        self.assertFalse(os.path.exists(library_path))
+        self.assertTrue(os.path.exists(library_path + JOURNAL_SUFFIX))
+
+        il = ImageLibrary(library_path)
+        self.assertEqual(il.records, {(10, 6): [ImageRecord(self.img_of_2, '2')]})
+        self.assertEqual(list(il.quarantine), [ImageRecord(self.img_of_3, None)])
+        il.delete(ImageRecord(self.img_of_3, None))
+        il.save_changes()
+        self.assertEqual(len(ImageLibrary(library_path).quarantine), 0)
+        with open(library_path + JOURNAL_SUFFIX, 'a') as file:
+            file.write('{"op": "add", "sha')  # crash during writing
+
+        il = ImageLibrary(library_path)
+        self.assertEqual(il.records, {(10, 6): [ImageRecord(self.img_of_2, '2')]})
+        # Changes after the broken line survive replaying
+        il.relabel(il.records[(10, 6)][0], 'two')
+        il.save_changes()
+        il = ImageLibrary(library_path)
+        self.assertEqual(il.records, {(10, 6): [ImageRecord(self.img_of_2, 'two')]})
+        il.save_library()
+        self.assertFalse(os.path.exists(library_path + JOURNAL_SUFFIX))
+        self.assertEqual(ImageLibrary(library_path).records, {(10, 6): [ImageRecord(self.img_of_2, 'two')]})
+
+    def test_text_cache(self):
+        cache_path = self.path('text_cache_test.json')
+        cache = TextCache(size=1)
+        cache.put('a', '12', ['digest_1', 'digest_2'])
+        cache.put('b', '$0.25', ['digest_3'])
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), '$0.25')
+        cache.invalidate('digest_3')
+        self.assertEqual(cache.get('b'), None)
+
+        cache = TextCache(size=1, path=cache_path)
+        cache.put('a', '12', ['digest_1', 'digest_2'])
+        cache.put('b', '$0.25', ['digest_3'])
+        cache.save()
+        cache = TextCache(size=1, path=cache_path)
+        cache.load()
+        self.assertEqual(cache.get('a'), '12')
+        self.assertEqual(cache.get('b'), '$0.25')
+        cache.invalidate('digest_2')
+        self.assertEqual(cache.get('a'), None)
+
+    def test_convert_library(self):
+        library_path = self.path('symbols_test.dat')
+        with open(library_path, 'wb') as file:
+            pickle.dump({(10, 6): [ImageRecord(self.img_of_2, '2')]}, file)
+        convert_library(library_path)
+        with open(library_path, 'rb') as file:
+            self.assertEqual(file.read(len(LIBRARY_MAGIC)), LIBRARY_MAGIC)
+        self.assertEqual(ImageLibrary(library_path).records, {(10, 6): [ImageRecord(self.img_of_2, '2')]})
 
     def test_recognize_symbol(self):
         il = ImageLibrary(records={(10, 6): [ImageRecord(self.img_of_2, '2')]})
@@ -121,6 +217,302 @@ class ImageLibraryTest(unittest.TestCase):
         il.delete(ImageRecord(self.img_of_2, '2'))
         self.assertEqual(len([r for r in il]), 1)
 
+    def test_index(self):
+        il = ImageLibrary(records={(10, 6): [ImageRecord(self.img_of_2, '2')]})
+        was_created, symbol_record = il.get_image_record(self.img_of_2.copy())
+        self.assertFalse(was_created)
+        self.assertIs(symbol_record, il.records[(10, 6)][0])
+        self.assertIs(il.index[((10, 6), self.img_of_2.tobytes())], symbol_record)
+
+        il.delete(ImageRecord(self.img_of_2, '2'))
+        was_created, symbol_record = il.get_image_record(self.img_of_2)
+        self.assertTrue(was_created)
+        self.assertEqual(symbol_record.text, None)
+
+    def test_match_template(self):
+        il = ImageLibrary(records={(10, 6): [ImageRecord(self.img_of_2, '2'),
+                                             ImageRecord(self.img_of_3, '3')]})
+        symbol_record, matching = il._match_template(self.img_of_3)
+        self.assertEqual(symbol_record.text, '3')
+        self.assertAlmostEqual(matching, cv2.matchTemplate(self.img_of_3, self.img_of_3, cv2.TM_CCOEFF_NORMED)[0][0],
+                               places=5)
+        _, matching = il._match_template(self.img_of_2)
+        self.assertAlmostEqual(matching, 1.0, places=5)
+
+        noisy_flag = rus_array.copy()
+        noisy_flag[5:8, 3:6] += 2
+        library = ImageLibrary(records={(16, 22, 3): [ImageRecord(rus_array, 'rus')]})
+        was_created, image_record = library.get_image_record(noisy_flag)
+        self.assertFalse(was_created)
+        self.assertEqual(image_record.text, 'rus')
+
+    def test_get_nearest_record(self):
+        il = ImageLibrary(records={(10, 6): [ImageRecord(self.img_of_2, '2'),
+                                             ImageRecord(self.img_of_3, '3')]})
+        noisy_3 = self.img_of_3.copy()
+        noisy_3[0, 0] = 255
+        was_created, symbol_record = il.get_nearest_record(noisy_3, max_distance=1)
+        self.assertFalse(was_created)
+        self.assertEqual(symbol_record.text, '3')
+
+        noisy_2 = self.img_of_2.copy()
+        noisy_2[0, 0] = 255
+        was_created, symbol_record = il.get_nearest_record(noisy_2, max_distance=0)
+        self.assertTrue(was_created)
+        self.assertEqual(symbol_record.text, None)
+        self.assertEqual(len([r for r in il]), 3)
+
+    def test_quarantine(self):
+        il = ImageLibrary(records={(10, 6): [ImageRecord(self.img_of_2, '2')]})
+        was_created, record = il.get_image_record(self.img_of_3)
+        self.assertTrue(was_created)
+        was_created, same_record = il.get_image_record(self.img_of_3.copy())
+        self.assertFalse(was_created)
+        self.assertIs(same_record, record)
+        self.assertEqual(record.hits, 2)
+        self.assertEqual(il.records, {(10, 6): [ImageRecord(self.img_of_2, '2')]})
+        self.assertEqual(len(il._get_stack((10, 6))[1]), 1)
+
+        il.relabel(record, '3')
+        self.assertEqual(len(il.quarantine), 0)
+        self.assertEqual(il.records[(10, 6)], [ImageRecord(self.img_of_2, '2'), ImageRecord(self.img_of_3, '3')])
+        self.assertEqual(il.get_image_record(self.img_of_3), (False, record))
+
+    def test_quarantine_size(self):
+        quarantine = Quarantine(size=2)
+        images = [np.full((10, 6), value, dtype=np.uint8) for value in range(3)]
+        for image in images + images[2:]:
+            quarantine.get(image)
+        self.assertEqual([record.image[0, 0] for record in quarantine], [1, 2])
+        self.assertEqual([record.hits for record in quarantine], [1, 2])
+        self.assertIsNotNone(quarantine.find(_digest(images[1])))
+
+    def test_quarantine_journal(self):
+        library_path = self.path('quarantine_test.dat')
+        quarantine_path = library_path + QUARANTINE_SUFFIX
+        il = ImageLibrary(library_path)
+        il.get_image_record(self.img_of_2)
+        il.get_image_record(self.img_of_3)
+        il.save_changes()
+        # Saving appends to the journal instead of rewriting the quarantine
+        self.assertFalse(os.path.exists(quarantine_path))
+        with open(quarantine_path + JOURNAL_SUFFIX) as file:
+            self.assertEqual(len(file.readlines()), 2)
+        il.get_image_record(self.img_of_3)
+        il.save_changes()
+        with open(quarantine_path + JOURNAL_SUFFIX) as file:
+            lines = file.readlines()
+        self.assertEqual(len(lines), 3)
+        self.assertNotIn('image', json.loads(lines[-1]))
+
+        il = ImageLibrary(library_path)
+        self.assertEqual({_digest(record.image): record.hits for record in il.quarantine},
+                         {_digest(self.img_of_2): 1, _digest(self.img_of_3): 2})
+        il.relabel(il.quarantine.find(_digest(self.img_of_2)), '2')
+        il.save_changes()
+        self.assertEqual(len(ImageLibrary(library_path).quarantine), 1)
+
+        il.save_library()
+        self.assertTrue(os.path.exists(quarantine_path))
+        self.assertFalse(os.path.exists(quarantine_path + JOURNAL_SUFFIX))
+        il = ImageLibrary(library_path)
+        self.assertEqual([(record.image.tolist(), record.hits) for record in il.quarantine],
+                         [(self.img_of_3.tolist(), 2)])
+
+    def test_hits(self):
+        library_path = self.path('hits_test.dat')
+        il = ImageLibrary(library_path)
+        il.records = {(10, 6): [ImageRecord(self.img_of_2, '2'), ImageRecord(self.img_of_3, '3')]}
+        il.save_library()
+        il = ImageLibrary(library_path)
+        for _ in range(3):
+            il.get_image_record(self.img_of_3)
+        record_of_3 = il.records[(10, 6)][1]
+        self.assertEqual(record_of_3.hits, 3)
+        self.assertIsNotNone(record_of_3.last_seen)
+        il.save_changes()
+        self.assertTrue(os.path.exists(library_path + HITS_SUFFIX))
+
+        il = ImageLibrary(library_path)
+        self.assertEqual([record.hits for record in il.records[(10, 6)]], [0, 3])
+        il.save_library()
+        self.assertFalse(os.path.exists(library_path + HITS_SUFFIX))
+        il = ImageLibrary(library_path)
+        self.assertEqual([record.text for record in il.records[(10, 6)]], ['3', '2'])
+        self.assertEqual(il.records[(10, 6)][0].hits, 3)
+        self.assertEqual(il.records[(10, 6)][0].last_seen, record_of_3.last_seen)
+
+    def test_hot_records(self):
+        records = [ImageRecord(np.full((10, 6), value, dtype=np.uint8), str(value)) for value in range(4)]
+        records.append(ImageRecord(self.img_of_3, '3'))
+        il = ImageLibrary(records={(10, 6): records})
+        noisy_3 = self.img_of_3.copy()
+        noisy_3[0, 0] = 255
+        with mock.patch('scanner.settings.LIBRARY_HOT_RECORDS', 2):
+            self.assertEqual(il.get_nearest_record(noisy_3, max_distance=1)[1].text, '3')
+            il.get_image_record(self.img_of_2)
+            il.order_by_hits()
+            noisy_3[0, 0], noisy_3[1, 1] = 0, 255
+            self.assertEqual(il.get_nearest_record(noisy_3, max_distance=1)[1].text, '3')
+            self.assertEqual(il.get_image_record(self.img_of_3)[1].text, '3')
+        self.assertEqual(il.lookup_stages[(10, 6), FULL_STAGE], 1)
+        self.assertEqual(il.lookup_stages[(10, 6), INDEX_STAGE], 1)
+        self.assertEqual(il.lookup_stages[(10, 6), HOT_STAGE], 1)
+        self.assertEqual(il.lookup_stages[(10, 6), MISS_STAGE], 1)
+        self.assertEqual(il.lookup_candidates[(10, 6)], 5 + 5 + 2)
+        self.assertEqual(il.records[(10, 6)][0].hits, 3)
+
+        report = il.report()
+        self.assertIn('Records: 5; Hits: 3; Dead: 4', report)
+        self.assertIn('Depth of hits 8: 100%', report)
+        self.assertIn('Lookups: 4; index: 1 hot: 1 full: 1 miss: 1; Hit rate: 75.0%; Candidates per lookup: 3.0',
+                      report)
+
+    def test_cluster_images(self):
+        noisy_2 = self.img_of_2.copy()
+        noisy_2[0, 0] = 255
+        noisy_3 = self.img_of_3.copy()
+        noisy_3[0, 0] = 255
+        images = [self.img_of_2, self.img_of_3, noisy_2, noisy_3]
+        self.assertEqual(cluster_images(images, HAMMING_MATCHER, max_distance=1), [[0, 2], [1, 3]])
+        self.assertEqual(cluster_images(images, HAMMING_MATCHER, max_distance=0), [[0], [1], [2], [3]])
+
+        noisy_flag = rus_array.copy()
+        noisy_flag[5:8, 3:6] += 2
+        flat = np.zeros_like(rus_array)
+        images = [rus_array, flat, noisy_flag, flat + 1]
+        self.assertEqual(cluster_images(images), [[0, 2], [1, 3]])
+
+    def test_compact(self):
+        library_path = self.path('compact_test.dat')
+        compacted_path = self.path('compacted_test.dat')
+        noisy_2 = self.img_of_2.copy()
+        noisy_2[0, 0] = 255
+        other_noisy_2 = self.img_of_2.copy()
+        other_noisy_2[1, 1] = 255
+        noisy_3 = self.img_of_3.copy()
+        noisy_3[0, 0] = 255
+        il = ImageLibrary(records={(10, 6): [ImageRecord(noisy_2, '2', hits=1), ImageRecord(self.img_of_2, '2', hits=5),
+                                             ImageRecord(self.img_of_3, '3', hits=2), ImageRecord(noisy_3, '8')]})
+        il.quarantine.add(ImageRecord(other_noisy_2, None, hits=3))
+        conflicts = il.compact(HAMMING_MATCHER, max_distance=1)
+        self.assertEqual([[record.text for record in cluster] for cluster in conflicts], [['3', '8']])
+        self.assertEqual([(record.text, record.hits) for record in il.records[(10, 6)]], [('2', 9), ('3', 2), ('8', 0)])
+        self.assertIs(il.records[(10, 6)][0].image, self.img_of_2)
+        self.assertEqual(len(il.quarantine), 0)
+        self.assertEqual([change['op'] for change in il._changes], ['delete'])
+        self.assertEqual(il.get_nearest_record(other_noisy_2, max_distance=1)[1].text, '2')
+
+        il = ImageLibrary(library_path)
+        il.records = {(10, 6): [ImageRecord(noisy_2, '2', hits=1), ImageRecord(self.img_of_2, '2', hits=5)]}
+        il.save_library()
+        # The persistent text cache is saved next to the compacted library, without texts of the merged records
+        texts = [['a', '22', [_digest(noisy_2), _digest(self.img_of_2)]], ['b', '2', [_digest(self.img_of_2)]]]
+        with open(library_path + TEXT_CACHE_SUFFIX, 'w') as file:
+            json.dump(texts, file)
+        with mock.patch('builtins.print'), mock.patch('scanner.settings.TEXT_CACHE_PERSISTENT', True):
+            self.assertEqual(compact_library(library_path, compacted_path, HAMMING_MATCHER), [])
+        self.assertEqual(len(ImageLibrary(library_path).records[(10, 6)]), 2)
+        self.assertEqual(ImageLibrary(compacted_path).records, {(10, 6): [ImageRecord(self.img_of_2, '2')]})
+        with open(library_path + TEXT_CACHE_SUFFIX) as file:
+            self.assertEqual(json.load(file), texts)
+        with open(compacted_path + TEXT_CACHE_SUFFIX) as file:
+            self.assertEqual(json.load(file), texts[1:])
+
+
+class ImageWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_submit(self):
+        writer = ImageWriter(directory=self.directory, queue_size=10, compression=9)
+        image = np.eye(10, 6, dtype=np.uint8) * 255
+        file_names = []
+        writer.submit(image, 'eye', on_saved=file_names.append)
+        image[:] = 0  # Reused buffer
+        self.assertTrue(writer.flush(5))
+        file_name, = file_names
+        self.assertTrue(file_name.startswith('eye-'))
+        self.assertTrue(np.array_equal(cv2.imread(os.path.join(self.directory, file_name), cv2.IMREAD_GRAYSCALE),
+                                       np.eye(10, 6, dtype=np.uint8) * 255))
+
+    def test_drop_oldest(self):
+        writer = ImageWriter(directory=self.directory, queue_size=2)
+        release = threading.Event()
+        started = threading.Event()
+        imwrite = cv2.imwrite
+
+        def blocked_write(path, image, params):
+            started.set()
+            release.wait(5)
+            return imwrite(path, image, params)
+
+        images = [np.full((2, 2), value, dtype=np.uint8) for value in range(4)]
+        file_names = []
+        with mock.patch('scanner.ocr.cv2.imwrite', blocked_write):
+            writer.submit(images[0], 'image', on_saved=file_names.append)
+            started.wait(5)
+            for image in images[1:]:
+                writer.submit(image, 'image', on_saved=file_names.append)
+            release.set()
+            self.assertTrue(writer.flush(5))
+        # The dropped image isn't reported as saved
+        self.assertEqual(writer.dropped, 1)
+        self.assertEqual(len(file_names), 3)
+        self.assertEqual(sorted(os.listdir(self.directory)), sorted(file_names + [ImageStore.INDEX_FILE]))
+
+        with mock.patch('scanner.ocr.cv2.imwrite', return_value=False), mock.patch('scanner.ocr.log.error'):
+            writer.submit(images[1] + 10, 'image', on_saved=file_names.append)
+            self.assertTrue(writer.flush(5))
+        self.assertEqual(len(file_names), 3)
+
+    def test_image_logger(self):
+        writer = ImageWriter(directory=self.directory)
+        logger = ImageLogger('image_logger_test')
+        with mock.patch('scanner.ocr.image_writer', writer), self.assertLogs(logger, 'WARNING') as logs:
+            logger.warning("Unknown glyph", extra={'images': [(np.eye(4, dtype=np.uint8) * 255, 'glyph')]})
+            self.assertTrue(writer.flush(5))
+        self.assertEqual(logs.output[0], 'WARNING:image_logger_test:Unknown glyph')
+        self.assertTrue(logs.output[1].startswith("WARNING:image_logger_test:Image of 'Unknown glyph' saved under "
+                                                  "name glyph-"))
+
+    def test_sampling(self):
+        writer = ImageWriter(directory=self.directory, sampling={'row': 3})
+        self.assertEqual([writer.is_sampled('row') for _ in range(7)], [True, False, False, True, False, False, True])
+        self.assertTrue(writer.is_sampled('wrong-row'))
+        self.assertTrue(writer.is_sampled('wrong-row'))
+
+    def test_store(self):
+        store = ImageStore(self.directory, max_size=10 ** 6)
+        glyph = np.eye(10, 6, dtype=np.uint8) * 255
+        store.add(glyph, 'glyph-1.png', 'glyph', 1.0)
+        store.add(glyph, 'glyph-1.png', 'glyph', 2.0)
+        store.add(glyph, 'flag-1.png', 'flag', 3.0)
+        store.save()
+        self.assertEqual(sorted(os.listdir(self.directory)), ['flag-1.png', 'glyph-1.png', ImageStore.INDEX_FILE])
+
+        store = ImageStore(self.directory, max_size=10 ** 6)
+        store.load()
+        self.assertEqual(list(store.entries), ['glyph-1.png', 'flag-1.png'])
+        self.assertEqual(store.entries['glyph-1.png']['count'], 2)
+        self.assertEqual(store.entries['glyph-1.png']['first_seen'], 1.0)
+        self.assertEqual(store.entries['glyph-1.png']['last_seen'], 2.0)
+
+    def test_store_eviction(self):
+        store = ImageStore(self.directory, max_size=10 ** 6)
+        for index in range(3):
+            store.add(np.full((10, 10), index, dtype=np.uint8), '{}.png'.format(index), 'image', float(index))
+        store.add(np.full((10, 10), 0, dtype=np.uint8), '0.png', 'image', 3.0)
+        store.max_size = store.size - 1
+        store.add(np.full((10, 10), 3, dtype=np.uint8), '3.png', 'image', 4.0)
+        self.assertEqual(list(store.entries), ['0.png', '3.png'])
+        self.assertEqual(sorted(os.listdir(self.directory)), ['0.png', '3.png'])
+        self.assertEqual(store.size, sum(os.path.getsize(os.path.join(self.directory, name))
+                                         for name in os.listdir(self.directory)))
+
 
 class TestParsers(unittest.TestCase):
     @classmethod
@@ -166,6 +558,78 @@ class TestParsers(unittest.TestCase):
             recognize_row(self.players_list_empty, zone=zone)
         self.assertEqual(raised.exception.args[0], "Can't recognize row")
 
+    def test_row_tracker(self):
+        zone = (170, 171)
+        tracker = RowTracker()
+        metrics.reset()
+        self.assertTrue(np.array_equal(recognize_row(self.players_img_1, zone, tracker), self.row_img_1))
+        self.assertTrue(np.array_equal(recognize_row(self.players_img_2, zone, tracker), self.row_img_2))
+        self.assertTrue(np.array_equal(recognize_row(self.players_img_3, zone, tracker), self.row_img_3))
+        self.assertTrue(np.array_equal(recognize_row(self.players_img_3, zone, tracker), self.row_img_3))
+        self.assertTrue(np.array_equal(recognize_row(self.players_img_2, zone, tracker), self.row_img_2))
+        self.assertEqual((tracker.top, tracker.height), (21, 21))
+        self.assertFalse(metrics.counters)
+
+        self.assertTrue(np.array_equal(recognize_row(self.players_img_4, zone, tracker), self.row_img_4))
+        self.assertEqual(metrics.counters['row_tracker_misses'], 1)
+        self.assertEqual(len(recognize_rows(self.players_img_1, zone, tracker)), 20)
+        self.assertEqual(metrics.counters['row_tracker_misses'], 2)
+        with self.assertRaises(ValueError):
+            recognize_row(self.players_list_empty, zone, tracker)
+        self.assertIsNone(tracker.top)
+
+    def test_find_rows(self):
+        zone = (170, 171)
+        rows = recognize_rows(self.players_img_1, zone=zone)
+        self.assertEqual(len(rows), 20)
+        self.assertTrue(np.array_equal(rows[0], self.row_img_1))
+        self.assertTrue(np.array_equal(rows[1], self.players_img_1[21:42]))
+        self.assertEqual(len(recognize_rows(self.players_img_3, zone=zone)), 18)
+        with self.assertRaises(ValueError):
+            recognize_rows(self.players_list_empty, zone=zone)
+
+    def test_recognize_text_not_current_row(self):
+        library = ImageLibrary(records={(10, 6): [
+            ImageRecord(self.img_of_2, '2'),
+            ImageRecord(self.img_of_3, '3'),
+        ]
+        })
+        rows = recognize_rows(self.players_img_1, zone=(170, 171))
+        self.assertEqual(recognize_characters(rows[1], zone=(190, 220), library=library), '3')
+
+    def test_prepared_row(self):
+        library = ImageLibrary()
+        buffers = RowBuffers()
+        row = PreparedRow(self.row_img_2, buffers)
+        with self.assertRaises(CharacterDoesNotExist):
+            recognize_characters(row, zone=(190, 220), library=library)
+        # Only the zone of the field is converted
+        self.assertEqual(list(row._thresholds), [(160, cv2.THRESH_BINARY, (190, 220))])
+        self.assertEqual(row.gray((190, 220)).shape, (self.row_img_2.shape[0], 30))
+        created_record = next(iter(library))
+        created_image = created_record.image.copy()
+
+        next_row = PreparedRow(self.row_img_1, buffers)
+        self.assertIs(next_row.threshold(160, cv2.THRESH_BINARY, (190, 220)),
+                      buffers.get(('threshold', 160, cv2.THRESH_BINARY, (190, 220)), (self.row_img_1.shape[0], 30)))
+        self.assertTrue(np.array_equal(created_record.image, created_image))
+
+    def test_segment_by_projection(self):
+        for players_img in (self.players_img_1, self.players_img_2, self.players_img_3, self.players_img_4):
+            for top in range(0, players_img.shape[0] - 21, 21):
+                gray_image = cv2.cvtColor(players_img[top:top + 21, 190:220], cv2.COLOR_BGR2GRAY)
+                threshold_type = cv2.THRESH_BINARY_INV if np.median(gray_image) > 160 else cv2.THRESH_BINARY
+                _, thresh = cv2.threshold(gray_image, 160, 255, threshold_type)
+                self.assertEqual(_segment_by_projection(thresh), _segment_by_contours(thresh.copy()))
+
+        thresh = np.zeros((10, 30), dtype=np.uint8)
+        thresh[1:9, 2:5] = 255
+        thresh[3:9, 6:8] = 255
+        thresh[0:5, 14:16] = 255
+        thresh[2:4, 17:29] = 255
+        self.assertEqual(_segment_by_projection(thresh), ([(2, 1, 3, 8), (6, 3, 2, 6), (14, 0, 2, 5)],
+                                                          [False, False, True]))
+
     def test_recognize_text_entry(self):
         library = ImageLibrary(records={(10, 6): [
             ImageRecord(self.img_of_2, '2'),
@@ -180,6 +644,31 @@ class TestParsers(unittest.TestCase):
         text = recognize_characters(self.row_img_2, zone=zone, library=library)
         self.assertEqual(text, '3')
 
+        text = recognize_characters(self.row_img_1, zone=zone, library=library, matcher=HAMMING_MATCHER)
+        self.assertEqual(text, '2')
+
+        text = recognize_characters(self.row_img_2, zone=zone, library=library, segmenter=PROJECTION_SEGMENTER)
+        self.assertEqual(text, '3')
+
+    def test_recognize_text_cache(self):
+        library = ImageLibrary(records={(10, 6): [
+            ImageRecord(self.img_of_2, '2'),
+            ImageRecord(self.img_of_3, '3'),
+        ]
+        })
+        zone = (190, 220)
+        self.assertEqual(recognize_characters(self.row_img_1, zone=zone, library=library), '2')
+        self.assertEqual(library.text_cache.misses, 1)
+        self.assertEqual(recognize_characters(self.row_img_1, zone=zone, library=library), '2')
+        self.assertEqual(library.text_cache.hits, 1)
+        # Records of the cached text count hits as well
+        self.assertEqual(library.records[(10, 6)][0].hits, 2)
+        self.assertEqual(library.records[(10, 6)][1].hits, 0)
+
+        library.relabel(library.records[(10, 6)][0], 'Z')
+        self.assertEqual(recognize_characters(self.row_img_1, zone=zone, library=library), 'Z')
+        self.assertEqual(library.text_cache.misses, 2)
+
     def test__find_flag(self):
         library = ImageLibrary(records={(16, 22, 3): [ImageRecord(rus_array,'rus')]})
         flag_image = _distinguish_flag(self.row_img_1[:, 140:170])
@@ -198,6 +687,13 @@ class TestParsers(unittest.TestCase):
         was_created, image_record = _find_flag(flag_image, library)
         self.assertEqual(was_created, False)
         self.assertEqual(image_record.text, None)
+        self.assertEqual(len(library.records[(16, 22, 3)]), 1)
+
+        # Labelled brazil
+        library.relabel(image_record, 'bra')
+        was_created, image_record = _find_flag(flag_image, library)
+        self.assertEqual(was_created, False)
+        self.assertEqual(image_record.text, 'bra')
 
     def test_recognize_flag(self):
         library = ImageLibrary(records={(16, 22, 3): [ImageRecord(rus_array,'rus')]})
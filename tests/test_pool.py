@@ -0,0 +1,135 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from scanner import client
+from scanner import settings
+from scanner.client import Client, ClientList, ListItem, ListRow
+from scanner.metrics import metrics
+from scanner.ocr import ImageLibrary, PreparedRow, _digest
+from scanner.pool import OcrPool
+from scanner.replay import ReplayClipboard, ReplayListControl, ReplayWindow
+from synthetic_lists import ListRenderer, load_libraries, random_lobby, PLAYER_LIST_WIDTH
+
+
+class OcrPoolTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        libraries = load_libraries()
+        renderer = ListRenderer(settings.POKERSTARS['player_fields'], libraries, width=PLAYER_LIST_WIDTH)
+        players = random_lobby(1, 30, libraries, seed=2)[0]['players']
+        cls.missing_country = players[0]['country']
+        cls.players = players
+        cls.rows = [renderer.render_row(player) for player in players]
+        cls.renderer = renderer
+
+        # The flag library of the scanner doesn't know one country of the players
+        cls.directory = tempfile.mkdtemp()
+        library_files = settings.POKERSTARS['libraries']
+        shutil.copy(os.path.join(settings.PACKAGE_DIR, library_files['pokerstars_characters']), cls.directory)
+        flags = ImageLibrary(os.path.join(cls.directory, library_files['pokerstars_flags']))
+        flags.records = {image_size: [record for record in records if record.text != cls.missing_country]
+                         for image_size, records in libraries['pokerstars_flags'].records.items()}
+        flags.save_library()
+        cls.saved_libraries = dict(client.libraries)
+
+    @classmethod
+    def tearDownClass(cls):
+        client.libraries.clear()
+        client.libraries.update(cls.saved_libraries)
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        # Every test changes its own copy of the libraries
+        self.library_dir = tempfile.mkdtemp()
+        for file_name in settings.POKERSTARS['libraries'].values():
+            shutil.copy(os.path.join(self.directory, file_name), self.library_dir)
+        self.load_libraries()
+
+    def tearDown(self):
+        shutil.rmtree(self.library_dir)
+
+    def load_libraries(self):
+        client.libraries.clear()
+        Client(library_dir=self.library_dir).load_libraries()
+        metrics.reset()
+
+    def quarantine(self):
+        return {_digest(record.image): record.hits for record in client.libraries['pokerstars_flags'].quarantine}
+
+    def flag_hits(self):
+        return {_digest(record.image): record.hits for record in client.libraries['pokerstars_flags'] if record.hits}
+
+    def test_recognize(self):
+        with OcrPool({'player_fields': settings.POKERSTARS['player_fields']}, processes=2) as pool:
+            values = pool.recognize('player_fields', self.rows)
+            self.assertEqual(pool.recognize('player_fields', []), [])
+        quarantine = self.quarantine()
+        flag_hits = self.flag_hits()
+        counters = dict(metrics.counters)
+
+        self.load_libraries()
+        items = ListItem.fields_from_dict(settings.POKERSTARS['player_fields'])
+        serial_values = [{item.name: item.recognize(PreparedRow(row)) for item in items} for row in self.rows]
+
+        self.assertEqual(values, serial_values)
+        self.assertEqual(quarantine, self.quarantine())
+        self.assertTrue(flag_hits)
+        self.assertEqual(flag_hits, self.flag_hits())
+        self.assertEqual(counters, dict(metrics.counters))
+        missing = [player for player in self.players if player['country'] == self.missing_country]
+        self.assertEqual(list(quarantine.values()), [len(missing)])
+        self.assertEqual(counters['unknown_flags'], 1)
+        self.assertEqual(counters.get('unnamed_flags', 0), len(missing) - 1)
+        for player, row_values in zip(self.players, values):
+            if player['country'] != self.missing_country:
+                self.assertEqual(row_values, {'country': player['country'], 'entries': int(player['entries'])})
+
+    def test_reload_libraries(self):
+        missing = [player for player in self.players if player['country'] == self.missing_country]
+        with OcrPool({'player_fields': settings.POKERSTARS['player_fields']}, processes=2) as pool:
+            pool.recognize('player_fields', self.rows)
+            client.libraries['pokerstars_flags'].save_changes()
+
+            # Images, that weren't found, get into the quarantine of the loaded library
+            self.load_libraries()
+            pool.recognize('player_fields', self.rows)
+            self.assertEqual(list(self.quarantine().values()), [2 * len(missing)])
+            self.assertEqual(metrics.counters['unnamed_flags'], len(missing))
+
+            # The workers find the record, that was labelled after they have started
+            flags = client.libraries['pokerstars_flags']
+            record, = flags.quarantine
+            flags.relabel(record, self.missing_country)
+            flags.save_changes()
+            self.load_libraries()
+            values = pool.recognize('player_fields', self.rows)
+
+        self.assertEqual([row_values['country'] for row_values in values],
+                         [player['country'] for player in self.players])
+        self.assertEqual(dict(metrics.counters), {})
+        self.assertEqual(self.quarantine(), {})
+        # The promoted record keeps hits of the quarantine
+        self.assertEqual(self.flag_hits()[_digest(record.image)], 3 * len(missing))
+
+    def test_client_list(self):
+        recording_dir = os.path.join(self.directory, 'players')
+        self.renderer.write_recording(recording_dir, self.players)
+
+        def walk(pool):
+            clipboard = ReplayClipboard()
+            window = ReplayWindow({'list': ReplayListControl.from_directory(recording_dir, clipboard)})
+            player_list = ClientList(window, 'list', row=ListRow.from_dict(settings.POKERSTARS['player_list_row']),
+                                     items=ListItem.fields_from_dict(settings.POKERSTARS['player_fields']),
+                                     multi_row=True, clipboard_source=clipboard, pool=pool, pool_key='player_fields')
+            return list(player_list)
+
+        with OcrPool({'player_fields': settings.POKERSTARS['player_fields']}, processes=2) as pool:
+            values = walk(pool)
+        self.assertEqual(len(values), len(self.players))
+        self.assertEqual(values, walk(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image
+
+from scanner.replay import *
+
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.recording_dir = tempfile.mkdtemp()
+        self.make_recording('tables', ['Table 1', 'Table 2'], ['players_1.png', 'players_2.png'])
+        self.make_recording(os.path.join('players', '1'), ['AKA_SDK', 'Andrecgb'], ['players_1.png', 'players_2.png'])
+
+    def tearDown(self):
+        shutil.rmtree(self.recording_dir)
+
+    def make_recording(self, name, names, frames):
+        directory = os.path.join(self.recording_dir, name)
+        os.makedirs(directory)
+        with open(os.path.join(directory, NAMES_FILE), 'w', encoding='utf-8') as file:
+            file.write('\n'.join(names))
+        for index, frame in enumerate(frames):
+            shutil.copy(os.path.join('osr_data', frame), os.path.join(directory, '{}.png'.format(index)))
+
+    def test_read_recording(self):
+        names, frames = read_recording(os.path.join(self.recording_dir, 'tables'))
+        self.assertEqual(names, ['Table 1', 'Table 2'])
+        self.assertEqual(sorted(frames), [0, 1])
+
+    def test_list_control(self):
+        clipboard = ReplayClipboard()
+        control = ReplayListControl.from_directory(os.path.join(self.recording_dir, 'tables'), clipboard)
+        control.type_keys('^c')
+        self.assertEqual(clipboard.GetData(), 'Table 1')
+        control.type_keys('{DOWN}')
+        control.type_keys('{DOWN}')
+        control.type_keys('^c')
+        self.assertEqual(clipboard.GetData(), 'Table 2')
+        self.assertEqual(control.capture_as_image().size, Image.open('osr_data/players_2.png').size)
+        control.type_keys('^{HOME}')
+        self.assertEqual(control.position, 0)
+
+    def test_player_list_control(self):
+        clipboard = ReplayClipboard()
+        tables = ReplayListControl.from_directory(os.path.join(self.recording_dir, 'tables'), clipboard)
+        players = ReplayPlayerListControl(tables, os.path.join(self.recording_dir, 'players'), clipboard)
+        players.type_keys('^c')
+        self.assertIsNone(clipboard.GetData())
+        tables.type_keys('{DOWN}')
+        players.type_keys('{DOWN}')
+        players.type_keys('^c')
+        self.assertEqual(clipboard.GetData(), 'Andrecgb')
+
+        # The table without recorded players shows a black list
+        tables.type_keys('{UP}')
+        players.type_keys('^c')
+        self.assertIsNone(clipboard.GetData())
+        self.assertEqual(players.rectangle(), Rectangle(0, 0, *EMPTY_FRAME_SIZE))
+        self.assertEqual(players.capture_as_image().getextrema(), ((0, 0), (0, 0), (0, 0)))
@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from scanner.client import *
+from scanner.ocr import *
+from scanner.replay import ReplayClipboard, ReplayListControl, ReplayWindow
+from synthetic_lists import *
+
+
+class SyntheticListsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.libraries = load_libraries()
+        cls.characters = cls.libraries['pokerstars_characters']
+        cls.flags = cls.libraries['pokerstars_flags']
+        cls.renderer = ListRenderer(settings.POKERSTARS['player_fields'], cls.libraries, width=PLAYER_LIST_WIDTH)
+        cls.tables = random_lobby(1, 25, cls.libraries, seed=1)
+        cls.players = cls.tables[0]['players']
+
+    def test_render_list(self):
+        for position in (0, 7, 19, 24):
+            image = self.renderer.render_list(self.players, position)
+            self.assertEqual(image.shape, (VISIBLE_ROWS * ROW_HEIGHT, PLAYER_LIST_WIDTH, 3))
+            row = recognize_row(image, zone=(170, 171))
+            player = self.players[position]
+            self.assertEqual(recognize_characters(row, zone=(190, 220), library=self.characters), player['entries'])
+            self.assertEqual(recognize_flag(row, zone=(140, 170), library=self.flags), player['country'])
+
+    def test_render_not_current_rows(self):
+        image = self.renderer.render_list(self.players, 3)
+        rows = recognize_rows(image, zone=(170, 171))
+        self.assertEqual(len(rows), VISIBLE_ROWS - 3)
+        for row, player in zip(rows, self.players[3:]):
+            self.assertEqual(recognize_characters(row, zone=(190, 220), library=self.characters), player['entries'])
+            self.assertEqual(recognize_flag(row, zone=(140, 170), library=self.flags), player['country'])
+
+    def test_render_short_list(self):
+        image = self.renderer.render_list(self.players[:2], 1)
+        self.assertEqual(image.shape[0], VISIBLE_ROWS * ROW_HEIGHT)
+        # Empty rows below the end of the list aren't rows
+        self.assertEqual(len(recognize_rows(image, zone=(170, 171))), 1)
+        image = self.renderer.render_list(self.players[:3], 0)
+        self.assertEqual(len(recognize_rows(image, zone=(170, 171))), 3)
+
+    def test_render_unknown_character(self):
+        with self.assertRaises(ValueError):
+            self.renderer.render_row({'entries': 'x'})
+
+    def test_write_lobby(self):
+        directory = tempfile.mkdtemp()
+        try:
+            write_lobby(directory, self.tables, self.libraries)
+            clipboard = ReplayClipboard()
+            control = ReplayListControl.from_directory(os.path.join(directory, 'players', '0'), clipboard)
+            window = ReplayWindow({'PokerStarsList2': control})
+            items = [ListItem('entries', zone=(190, 220), recognizer=recognize_characters, parser=int_parser,
+                              library=self.characters)]
+            row = ListRow(recognizer=recognize_row, zone=(170, 171), rows_recognizer=recognize_rows)
+            player_list = ClientList(window, 'PokerStarsList2', row=row, items=items, multi_row=True,
+                                     clipboard_source=clipboard)
+            self.assertEqual(list(player_list),
+                             [{'name': player['name'], 'entries': int(player['entries'])} for player in self.players])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_short_list_multi_row(self):
+        directory = tempfile.mkdtemp()
+        try:
+            players = self.players[:3]
+            self.renderer.write_recording(directory, players)
+            clipboard = ReplayClipboard()
+            window = ReplayWindow({'PokerStarsList2': ReplayListControl.from_directory(directory, clipboard)})
+            player_list = ClientList(window, 'PokerStarsList2',
+                                     row=ListRow.from_dict(settings.POKERSTARS['player_list_row']),
+                                     items=[ListItem('country', zone=(140, 170), recognizer=recognize_flag,
+                                                     library=self.flags)],
+                                     multi_row=True, clipboard_source=clipboard)
+            with mock.patch('scanner.ocr.log.error') as ocr_error, mock.patch('scanner.client.log.error') as error:
+                self.assertEqual(list(player_list),
+                                 [{'name': player['name'], 'country': player['country']} for player in players])
+            self.assertFalse(ocr_error.called)
+            self.assertFalse(error.called)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_inflate_library(self):
+        inflated = inflate_library(self.characters, 100, changed_pixels=2)
+        self.assertEqual(len(list(inflated)), len(list(self.characters)) + 100)
+        self.assertEqual(len(list(self.characters)), 12)
+        image = self.renderer.render_row({'entries': '2'}, current=True)
+        self.assertEqual(recognize_characters(image, zone=(190, 220), library=inflated), '2')